@@ -0,0 +1,36 @@
+"""Stand-in for a TeX engine, used to benchmark probman's own overhead.
+
+It accepts the same command lines as pdflatex does when called by
+probman and writes a minimal PDF, log and aux file (or a format file
+when called with -ini) without typesetting anything.
+"""
+import sys
+from pathlib import Path
+
+PDF = (b'%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n'
+       b'2 0 obj<</Type/Pages/Kids[]/Count 0>>endobj\n'
+       b'trailer<</Root 1 0 R>>\n%%EOF\n')
+
+
+def main(argv):
+    files = [arg for arg in argv if not arg.startswith(('-', '&'))]
+    jobname = None
+    for arg in argv:
+        if arg.startswith('-jobname='):
+            jobname = arg.split('=', 1)[1]
+    if not files:
+        return 1
+    target = Path(files[-1])
+    if jobname is None:
+        jobname = target.stem if target.suffix == '.tex' else target.name
+    if '-ini' in argv:
+        Path(jobname + '.fmt').write_bytes(b'fake format\n')
+        return 0
+    Path(jobname + '.pdf').write_bytes(PDF)
+    Path(jobname + '.log').write_text('This is fake TeX, output written.\n')
+    Path(jobname + '.aux').write_text('\\relax\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,266 @@
+"""Timing and memory benchmarks for probman's hot paths.
+
+Builds a synthetic store (see synthetic.py) that uses a fake TeX engine,
+then times each benchmark and, in a separate run, records its peak
+traced memory. Results are written as JSON so runs from different
+versions can be compared:
+
+    python -m benchmarks.run --output new.json --compare old.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory, mkdtemp
+
+import probman
+from probman.checker import Checker
+from probman.parser import SheetParser
+
+from .synthetic import make_store
+
+BENCHMARKS = []
+
+# Seconds a bare 'probman --help' may take, see --startup-budget
+STARTUP_BUDGET = 0.25
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    # tracemalloc slows down every allocation, so the peak memory comes
+    # from one extra run outside of the timed ones
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'min': min(times), 'median': statistics.median(times),
+            'repeat': repeat, 'peak_memory': peak}
+
+
+def _clear_cache(store, name):
+    path = store.get_cache_dir() / name
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def _probman(*argv):
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(filter(None, (
+                   str(Path(probman.__file__).parents[1]),
+                   os.environ.get('PYTHONPATH')))))
+    code = 'from probman.cli import main; main()'
+    def run():
+        subprocess.run([sys.executable, '-c', code, *argv], env=env,
+                       stdout=subprocess.DEVNULL, check=True)
+    return run
+
+
+@benchmark
+def startup(store, args):
+    return _probman('--help')
+
+
+@benchmark
+def startup_store(store, args):
+    return _probman('config')
+
+
+@benchmark
+def parse_sheets(store, args):
+    def run():
+        with SheetParser(store.path,
+                         store.sheet_file(relative=store.path)) as parser:
+            for _ in parser.parse():
+                pass
+    return run
+
+
+@benchmark
+def get_sheets_cold(store, args):
+    def run():
+        _clear_cache(store, 'sheets.json')
+        store.get_sheets(['*'])
+    return run
+
+
+@benchmark
+def get_sheets_warm(store, args):
+    store.get_sheets(['*'])
+    return lambda: store.get_sheets(['*'])
+
+
+@benchmark
+def check_cold(store, args):
+    def run():
+        store.index.db.execute('DELETE FROM checks')
+        for _ in Checker(store, jobs=args.jobs):
+            pass
+    return run
+
+
+@benchmark
+def check_warm(store, args):
+    def run():
+        for _ in Checker(store, jobs=args.jobs):
+            pass
+    run()
+    return run
+
+
+@benchmark
+def render_templates(store, args):
+    sheets = store.get_sheets(['*'])
+    template = store.get_template(store.template)
+    def run():
+        for sheet in sheets:
+            sheet.render_mode('questions', template)
+    return run
+
+
+@benchmark
+def stage_attachments(store, args):
+    sheets = store.get_sheets(['*'])
+    def run():
+        root = Path(mkdtemp(dir=store.get_cache_dir()))
+        try:
+            for sheet in sheets:
+                build_dir = root / sheet.file_name
+                build_dir.mkdir()
+                for prob, _ in sheet.problems:
+                    prob.copy_attachments_to(build_dir)
+        finally:
+            shutil.rmtree(root)
+    return run
+
+
+@benchmark
+def search_cold(store, args):
+    def run():
+        store.search_index.rebuild()
+    return run
+
+
+@benchmark
+def search_warm(store, args):
+    store.search_index.update()
+    def run():
+        store.search('continuous NOT integral', limit=20)
+        store.search('"show that"', limit=20)
+    return run
+
+
+@benchmark
+def compile_full(store, args):
+    def run():
+        for _ in store.compile(args.mode, ['*'], jobs=args.jobs, force=True):
+            pass
+    return run
+
+
+@benchmark
+def compile_noop(store, args):
+    def run():
+        for _ in store.compile(args.mode, ['*'], jobs=args.jobs):
+            pass
+    run()
+    return run
+
+
+def compare(results, baseline):
+    print(f'{"benchmark":<20}{"old (s)":>12}{"new (s)":>12}{"change":>10}')
+    for name, new in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            continue
+        change = (new['min'] - old['min']) / old['min'] if old['min'] else 0
+        print(f'{name:<20}{old["min"]:>12.4f}{new["min"]:>12.4f}'
+              f'{change:>+10.1%}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('--problems', type=int, default=10000)
+    parser.add_argument('--sheets', type=int, default=1000)
+    parser.add_argument('--attachments', type=int, default=2)
+    parser.add_argument('--problems-per-sheet', type=int, default=10)
+    parser.add_argument('--mode', default='questions')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-k', '--select', action='append', default=[],
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--store', type=Path, default=None,
+                        help='use (or create) the store at this path')
+    parser.add_argument('-o', '--output', type=Path, default=None)
+    parser.add_argument('--compare', type=Path, default=None)
+    parser.add_argument('--startup-budget', type=float,
+                        default=STARTUP_BUDGET,
+                        help='fail if the startup benchmark takes longer '
+                             'than this many seconds')
+    args = parser.parse_args(argv)
+
+    with TemporaryDirectory() as tmp:
+        path = args.store or Path(tmp) / 'store'
+        start = time.perf_counter()
+        if (path / '.prob').exists():
+            from probman.problemstore import ProblemStore
+            store = ProblemStore.from_path(path)
+        else:
+            store = make_store(path, problems=args.problems,
+                               sheets=args.sheets,
+                               attachments=args.attachments,
+                               problems_per_sheet=args.problems_per_sheet)
+        print(f'Store ready in {time.perf_counter() - start:.2f}s',
+              file=sys.stderr)
+
+        results = {'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'parameters': {k: v for k, v in vars(args).items()
+                                  if k not in ('output', 'compare', 'store')},
+                   'benchmarks': dict()}
+        os.chdir(path)
+        for bench in BENCHMARKS:
+            name = bench.__name__
+            if args.select and not any(s in name for s in args.select):
+                continue
+            result = measure(bench(store, args), args.repeat)
+            results['benchmarks'][name] = result
+            print(f'{name:<20}{result["min"]:>10.4f}s '
+                  f'{result["peak_memory"] / 2**20:>8.1f} MiB',
+                  file=sys.stderr)
+        store.index.close()
+        os.chdir(tmp)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2, default=str))
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+    startup = results['benchmarks'].get('startup')
+    if startup is not None and startup['min'] > args.startup_budget:
+        sys.exit(f'Startup took {startup["min"]:.3f}s, over the budget of '
+                 f'{args.startup_budget:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Generate synthetic problem stores for benchmarking."""
+import os
+import random
+import stat
+import sys
+from pathlib import Path
+
+from probman.problemstore import ProblemStore
+
+TEMPLATE = r'''\documentclass[12pt]{article}
+
+\usepackage[margin=1in]{geometry}
+\usepackage{amsmath}
+\usepackage{amssymb}
+\usepackage{graphicx}
+
+\title{ {{- title -}} }
+\date{}
+
+\begin{document}
+\maketitle
+{{ intro }}
+
+\begin{enumerate}
+{% for problem, mark in problems %}
+\item
+{% if include_problems %}
+{{ problem.get_question() }}
+{% if mark is not none %}\hfill[{{ mark }}]{% endif %}
+{% endif %}
+{% if include_solutions %}
+\par\medskip
+\textbf{Solution}
+\par\smallskip
+{{ problem.get_solution() }}
+{% endif %}
+{% endfor %}
+\end{enumerate}
+
+\end{document}
+'''
+
+WORDS = ('show that the function is continuous differentiable integral '
+         'compute limit sequence series converges prove every bounded '
+         'group ring field matrix eigenvalue vector space basis').split()
+
+
+def _sentence(rng, n=20):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def _write_engine(conf_path):
+    fake = Path(__file__).resolve().with_name('fake_tex.py')
+    engine = conf_path / 'fake_tex'
+    engine.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{fake}" "$@"\n')
+    engine.chmod(engine.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP
+                 | stat.S_IXOTH)
+    return engine
+
+
+def make_store(path, problems=10000, sheets=1000, attachments=2,
+               problems_per_sheet=10, attachment_size=4096, seed=0):
+    """Create a synthetic store in path and return its ProblemStore.
+
+    The store uses the fake TeX engine, so compiling it measures only
+    probman's own overhead.
+    """
+    rng = random.Random(seed)
+    path = Path(path)
+    ProblemStore.create_directory(path)
+    conf_path = path / '.prob'
+    engine = _write_engine(conf_path)
+    config = (conf_path / 'config').read_text()
+    (conf_path / 'config').write_text(
+        config.replace('engine=pdflatex', f'engine={engine}'))
+    (conf_path / 'template').write_text(TEMPLATE)
+
+    problems_path = path / 'problems'
+    problems_path.mkdir()
+    ids = [f'P{i:06d}' for i in range(problems)]
+    for id_ in ids:
+        prob = problems_path / id_
+        attach = prob / 'attach'
+        attach.mkdir(parents=True)
+        figs = []
+        for j in range(attachments):
+            name = f'fig{j}.png'
+            (attach / name).write_bytes(os.urandom(attachment_size))
+            figs.append(f'\\includegraphics{{fig{j}}}')
+        (prob / 'problem.tex').write_text(
+            f'{_sentence(rng)} $x^{rng.randint(2, 9)}$.\n' + '\n'.join(figs))
+        (prob / 'solution.tex').write_text(_sentence(rng, 40) + '\n')
+
+    lines = ['semester=Autumn', 'intro=Answer all the questions.']
+    for i in range(sheets):
+        chosen = rng.sample(ids, min(problems_per_sheet, len(ids)))
+        lines.append(f'sheet{i:05d}')
+        lines.append(f'  title=Sheet {i}')
+        lines.append('  problems=' + ';'.join(f'{id_} {rng.randint(1, 10)}'
+                                               for id_ in chosen))
+    (conf_path / 'sheets').write_text('\n'.join(lines) + '\n')
+    return ProblemStore.from_path(path)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path')
+    parser.add_argument('--problems', type=int, default=10000)
+    parser.add_argument('--sheets', type=int, default=1000)
+    parser.add_argument('--attachments', type=int, default=2)
+    parser.add_argument('--problems-per-sheet', type=int, default=10)
+    args = parser.parse_args()
+    make_store(args.path, problems=args.problems, sheets=args.sheets,
+               attachments=args.attachments,
+               problems_per_sheet=args.problems_per_sheet)
@@ -1,10 +1,16 @@
-import pkgutil
 from pathlib import Path
-from contextvars import ContextVar
-from configparser import ConfigParser
 
 MAIN_CONFIG = Path.home() / '.probman'
-parser = ConfigParser()
-parser.read_string(pkgutil.get_data('probman', 'data/config').decode())
-GLOBALS = ContextVar('GLOBALS')
-GLOBALS.set({'config' : parser})
+# Shared by every thread and context, filled in by get_globals
+GLOBALS = {}
+
+def get_globals():
+    """Return the global state, reading the default configuration the
+    first time it is needed."""
+    if 'config' not in GLOBALS:
+        import pkgutil
+        from configparser import ConfigParser
+        parser = ConfigParser()
+        parser.read_string(pkgutil.get_data('probman', 'data/config').decode())
+        GLOBALS.setdefault('config', parser)
+    return GLOBALS
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import os
+from asyncio.subprocess import PIPE
+from contextlib import ExitStack, aclosing
+from pathlib import Path
+from subprocess import CompletedProcess
+
+from .checker import _scan_problem
+from .problemstore import (BuildResult, stage_build, build_status,
+                           discard_failed_build)
+from .trace import TRACER, span
+from .utils import (Limits, BuildTimeout, tex_passes, _rlimit_hooks,
+                    _set_rlimits, _kill_group)
+
+logger = logging.getLogger(__name__)
+
+
+async def run_limited_async(args, cwd=None, limits=None):
+    """Async counterpart of utils.run_limited.
+
+    If the calling task is cancelled, the process group is killed before
+    the cancellation propagates.
+    """
+    limits = limits or Limits()
+    preexec_fn, use_prlimit = _rlimit_hooks(limits)
+    proc = await asyncio.create_subprocess_exec(
+        *args, cwd=cwd, stdout=PIPE, stderr=PIPE,
+        start_new_session=os.name == 'posix', preexec_fn=preexec_fn)
+    try:
+        if use_prlimit:
+            _set_rlimits(proc.pid, limits)
+        stdout, stderr = await asyncio.wait_for(proc.communicate(),
+                                                limits.timeout)
+    except asyncio.TimeoutError:
+        _kill_group(proc)
+        await proc.wait()
+        raise BuildTimeout(f'{Path(args[0]).name} timed out after '
+                           f'{limits.timeout}s')
+    except BaseException:
+        _kill_group(proc)
+        # Reap the killed engine even while being cancelled
+        await asyncio.shield(proc.wait())
+        raise
+    return CompletedProcess(args, proc.returncode, stdout, stderr)
+
+async def tex_compile_async(file, *, limits=None, **options):
+    """Async counterpart of utils.tex_compile, returns a TexResult."""
+    passes = tex_passes(file, **options)
+    number = 1
+    try:
+        args = next(passes)
+        while True:
+            with span('engine pass', file=file.name, number=number):
+                ck = await run_limited_async(args, cwd=file.parent,
+                                             limits=limits)
+            number += 1
+            args = passes.send(ck)
+    except StopIteration as stop:
+        return stop.value
+
+async def _compile_variant(sheet, mode, target, output_to, engine_options,
+                           semaphore):
+    async with semaphore:
+        built, final = sheet.output_paths(target, output_to)
+        try:
+            result = await tex_compile_async(target, **engine_options)
+        except BuildTimeout as e:
+            logger.warning(f'{sheet.file_name} ({mode}): {e}')
+            return BuildResult(sheet, mode, None, 'timeout', 0)
+    if not result.success:
+        logger.warning(f'Build failed for {target}')
+        return BuildResult(sheet, mode, None, 'failed', 0)
+    pdf = await asyncio.to_thread(sheet.publish, built, final)
+    logger.info(f'Built {sheet.file_name} ({mode}) in {result.passes} '
+                'pass(es)')
+    return BuildResult(sheet, mode, pdf, 'built', result.passes)
+
+async def _build_sheet(task, semaphore):
+    with span('build', sheet=task.sheet.file_name, mode=task.label) as args:
+        async with semaphore:
+            jobs = await asyncio.to_thread(stage_build, task.sheet,
+                                           task.variants, task.build_dir,
+                                           task.includes,
+                                           task.engine_options)
+        results = await asyncio.gather(*(_compile_variant(*job, semaphore)
+                                         for job in jobs))
+        await asyncio.to_thread(discard_failed_build, task.build_dir,
+                                results)
+        args.update(status=build_status(results),
+                    passes=sum(result.passes for result in results))
+    return results
+
+async def write_and_compile(store, mode, sheets, output_to, template,
+                            concurrency=1, manifest=None, force=False,
+                            build_root=None):
+    """Async counterpart of ProblemStore.write_and_compile.
+
+    Yields a BuildResult per sheet and round as the builds complete. At
+    most concurrency engines run at once, all from the event loop thread;
+    rendering, staging and publishing run in worker threads. Closing the
+    iterator, or cancelling the task consuming it, kills the running
+    engines and still records the finished builds in manifest.
+    """
+    if not sheets:
+        raise ValueError('No sheets to build, aborting')
+
+    semaphore = asyncio.Semaphore(concurrency)
+    stack = ExitStack()
+    dst = Path(await asyncio.to_thread(stack.enter_context,
+                                       store.build_context(build_root)))
+    tasks = []
+    try:
+        plan = await asyncio.to_thread(
+            list, store.plan_builds(mode, sheets, output_to, template, dst,
+                                    manifest=manifest, force=force,
+                                    build_root=build_root))
+        digests = dict()
+        for item in plan:
+            if isinstance(item, BuildResult):
+                yield item
+            else:
+                digests.update(item.digests)
+                tasks.append(asyncio.ensure_future(
+                    _build_sheet(item, semaphore)))
+        for next_done in asyncio.as_completed(tasks):
+            for result in await next_done:
+                if manifest is not None and result.status == 'built':
+                    key = manifest.key(result.mode, result.sheet)
+                    manifest.record(key, *digests[key])
+                yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if manifest is not None:
+            await asyncio.to_thread(manifest.save)
+        await asyncio.to_thread(stack.close)
+    logger.debug(f'Finished building in {dst}')
+
+async def compile_sheets(store, mode, pats, concurrency=1, force=False,
+                         changed=False, problems=None):
+    """Async counterpart of ProblemStore.compile.
+
+    Like it, first yields the number of builds, then their BuildResults
+    as they complete.
+    """
+    def select():
+        with span('parse'):
+            return store.select_sheets(store.get_sheets(pats), mode,
+                                       changed=changed, problems=problems)
+
+    sheets = await asyncio.to_thread(select)
+    yield len(sheets)*len(store.get_rounds(mode))
+    if not sheets:
+        return
+    manifest = await asyncio.to_thread(store.get_build_manifest)
+    builds = write_and_compile(store, mode, sheets,
+                               store.get_output_dirs(mode), store.template,
+                               concurrency=concurrency, manifest=manifest,
+                               force=force)
+    async with aclosing(builds):
+        async for result in builds:
+            yield result
+
+async def check_problems(checker):
+    """Async iterator over the errors found by checker, see Checker.
+
+    Index lookups and fixes run in a worker thread, and scans in a
+    process pool if the checker has jobs > 1, otherwise in worker
+    threads. Fixes are applied as each scan completes.
+    """
+    store = checker.problem_store
+    ids = await asyncio.to_thread(store.list_problems)
+    looked_up = await asyncio.to_thread(lambda: [checker.lookup(id_)
+                                                 for id_ in ids])
+    to_scan = []
+    for problem, key, cached in looked_up:
+        if cached is None:
+            to_scan.append((problem, key))
+            continue
+        checker.errors[problem].extend(cached)
+        for err in cached:
+            yield err
+
+    loop = asyncio.get_running_loop()
+    tracer = TRACER.get()
+    pool = None
+    if checker.jobs > 1 and to_scan:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=checker.jobs)
+
+    async def scan(problem, key):
+        result = await loop.run_in_executor(pool, _scan_problem, problem,
+                                            tracer is not None)
+        return problem, key, result
+
+    def finish(problem, key, errors, fixes):
+        checker.record(problem, key, errors, fixes)
+        checker.apply_fixes(problem, fixes)
+
+    tasks = [asyncio.ensure_future(scan(*item)) for item in to_scan]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            problem, key, (errors, fixes, events) = await next_done
+            if tracer is not None:
+                tracer.extend(events)
+            await asyncio.to_thread(finish, problem, key, errors, fixes)
+            checker.errors[problem].extend(errors)
+            for err in errors:
+                yield err
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,281 @@
+import gzip
+import io
+import json
+import logging
+import lzma
+import shutil
+import tarfile
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+
+from .utils import read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'MANIFEST.json'
+PROBLEMS = 'problems'
+
+EXTENSIONS = {'targz': '.tar.gz', 'tarxz': '.tar.xz', 'zip': '.zip'}
+
+COMPRESSORS = {
+    'targz': lambda data: gzip.compress(data, compresslevel=6),
+    'tarxz': lambda data: lzma.compress(data, format=lzma.FORMAT_XZ),
+}
+
+
+class ParallelCompressor(io.RawIOBase):
+    """File-like object that compresses chunks in parallel.
+
+    Each chunk is compressed independently into a complete gzip member
+    or xz stream. The members are written in order, and the result is a
+    valid multi-member file that gzip, xz and tarfile read as one stream.
+    """
+
+    def __init__(self, fileobj, compress, jobs, chunk_size=1 << 22):
+        self.fileobj = fileobj
+        self.compress = compress
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+
+    def writable(self):
+        return True
+
+    def _drain(self, limit):
+        while len(self.pending) > limit:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def _submit(self, chunk):
+        self.pending.append(self.pool.submit(self.compress, bytes(chunk)))
+        self._drain(2 * self.jobs)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self._submit(self.buffer[:self.chunk_size])
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            if self.buffer:
+                self._submit(self.buffer)
+                self.buffer = bytearray()
+            self._drain(0)
+            self.pool.shutdown()
+        super().close()
+
+
+def archive_path(output, mode):
+    output = Path(output)
+    if not output.name.endswith(EXTENSIONS[mode]):
+        output = output.with_name(output.name + EXTENSIONS[mode])
+    return output
+
+
+def manifest_path(archive):
+    return archive.with_name(archive.name + '.manifest.json')
+
+
+def read_manifest(path):
+    """Read the manifest of an archive, or a manifest file written next
+    to one."""
+    path = Path(path)
+    if path.name.endswith('.json'):
+        manifest = read_json(path)
+        if manifest is None:
+            raise RuntimeError(f'Cannot read archive manifest {path}')
+        return manifest
+    with ArchiveReader(path) as reader:
+        return reader.manifest
+
+
+def make_manifest(store, base=None):
+    """Build the manifest of the store as it is now.
+
+    With a base manifest, only the problems whose content changed since
+    the base are included, and problems that have since been removed are
+    listed for deletion on restore.
+    """
+    index = store.index
+    state = {id_: index.content_hash(id_) for id_ in index.list_problems()}
+    if base is None:
+        included = sorted(state)
+        removed = []
+    else:
+        base_state = base['state']
+        included = sorted(id_ for id_, digest in state.items()
+                          if base_state.get(id_) != digest)
+        removed = sorted(id_ for id_ in base_state if id_ not in state)
+    return {'version': 1,
+            'id': uuid.uuid4().hex,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'base': base['id'] if base is not None else None,
+            'state': state,
+            'included': included,
+            'removed': removed}
+
+
+def _problem_members(store, ids):
+    for id_ in ids:
+        problem = store.get_problem(id_)
+        for path in problem.list_files():
+            rel = path.relative_to(problem.path).as_posix()
+            yield path, f'{PROBLEMS}/{id_}/{rel}'
+
+
+def _write_tar(fileobj, manifest, members, compression):
+    with tarfile.open(fileobj=fileobj, mode=f'w|{compression}') as tar:
+        data = json.dumps(manifest).encode()
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(data)
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(data))
+        for path, arcname in members:
+            tar.add(path, arcname=arcname, recursive=False)
+
+
+def _write_zip(fileobj, manifest, members):
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(MANIFEST, json.dumps(manifest))
+        for path, arcname in members:
+            zf.write(path, arcname)
+
+
+def write_archive(store, output, mode, base=None, jobs=1):
+    """Stream the problems of store into an archive.
+
+    The archive starts with a MANIFEST.json member, which is also written
+    next to the archive so it can serve as the base of a later
+    incremental archive. Returns the path of the archive and the manifest.
+    """
+    output = archive_path(output, mode)
+    manifest = make_manifest(store, base)
+    members = _problem_members(store, manifest['included'])
+    logger.info(f'Writing {len(manifest["included"])} problems to {output}')
+    with open(output, 'wb') as f:
+        if mode == 'zip':
+            if jobs > 1:
+                logger.warning('Parallel compression is not supported for '
+                               'zip archives, compressing serially')
+            _write_zip(f, manifest, members)
+        elif jobs > 1:
+            with ParallelCompressor(f, COMPRESSORS[mode], jobs) as out:
+                _write_tar(out, manifest, members, '')
+        else:
+            _write_tar(f, manifest, members, mode[3:])
+    write_json(manifest_path(output), manifest)
+    return output, manifest
+
+
+class ArchiveReader:
+    """Read the manifest and members of a tar or zip archive in order,
+    without extracting it."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.manifest = None
+        if zipfile.is_zipfile(self.path):
+            self.zip = zipfile.ZipFile(self.path)
+            self.tar = None
+            if MANIFEST in self.zip.namelist():
+                self.manifest = json.loads(self.zip.read(MANIFEST))
+        else:
+            self.zip = None
+            self.tar = tarfile.open(self.path, 'r:*')
+            first = self.tar.next()
+            if first is not None and first.name == MANIFEST:
+                self.manifest = json.load(self.tar.extractfile(first))
+            self.first = first
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close()
+
+    def members(self):
+        """Yield (name, open function) for each file in the archive.
+
+        The open function must be used before advancing to the next
+        member, since tar archives are read sequentially.
+        """
+        if self.zip is not None:
+            for info in self.zip.infolist():
+                if not info.is_dir() and info.filename != MANIFEST:
+                    yield info.filename, (lambda i=info: self.zip.open(i))
+        else:
+            member = self.first
+            while member is not None:
+                if member.isfile() and member.name != MANIFEST:
+                    yield member.name, (lambda m=member:
+                                        self.tar.extractfile(m))
+                member = self.tar.next()
+
+    def problem_members(self):
+        """Yield (problem id, path within the problem, open function)."""
+        for name, opener in self.members():
+            parts = PurePosixPath(name).parts
+            if (len(parts) < 3 or parts[0] != PROBLEMS
+                    or any(part in ('..', '') for part in parts)
+                    or name.startswith('/')):
+                logger.warning(f'Ignoring unexpected member {name}')
+                continue
+            yield parts[1], '/'.join(parts[2:]), opener
+
+
+def check_chain(manifests):
+    for prev, manifest in zip(manifests, manifests[1:]):
+        if manifest['base'] != prev['id']:
+            raise RuntimeError(f'Archive {manifest["id"]} is not based on '
+                               f'the archive before it ({prev["id"]})')
+    if manifests and manifests[0]['base'] is not None:
+        logger.warning('The first archive is incremental, problems missing '
+                       'from its base will not be restored')
+
+
+def restore_archives(store, paths):
+    """Restore a full archive followed by a chain of incrementals.
+
+    Returns the number of distinct problems in the store written by the
+    restore, and of those removed by it.
+    """
+    manifests = [read_manifest(path) for path in paths]
+    if any(manifest is None for manifest in manifests):
+        raise RuntimeError('Can only restore archives created by probman')
+    check_chain(manifests)
+    store.problems_path.mkdir(exist_ok=True)
+    written, removed = set(), set()
+    for path, manifest in zip(paths, manifests):
+        logger.info(f'Restoring {path}')
+        for id_ in manifest['included']:
+            if store.index.has_problem(id_):
+                store.rm_problem(id_)
+        with ArchiveReader(path) as reader:
+            for id_, rel, opener in reader.problem_members():
+                dst = store.problems_path / id_ / rel
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                with opener() as src, open(dst, 'wb') as f:
+                    shutil.copyfileobj(src, f)
+        for id_ in manifest['included']:
+            store.index.add(id_)
+        written.update(manifest['included'])
+        removed.difference_update(manifest['included'])
+        for id_ in manifest['removed']:
+            if store.index.has_problem(id_):
+                store.rm_problem(id_)
+                removed.add(id_)
+            written.discard(id_)
+    return len(written), len(removed)
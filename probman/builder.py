@@ -15,6 +15,9 @@ logger = logging.getLogger(__name__)
 
 def decode(data):
     return base64.b85decode(data.encode('ascii'))
+
+def encode(data):
+    return base64.b85encode(data).decode('ascii')
  
 def extract_figs(path, attachments):
     for attachment in attachments:
@@ -0,0 +1,227 @@
+import json
+import logging
+import shutil
+from collections import deque, namedtuple
+from pathlib import Path
+from tempfile import mkdtemp
+
+from .builder import encode, extract_figs
+
+logger = logging.getLogger(__name__)
+
+ImportResult = namedtuple('ImportResult', ('added', 'duplicates'))
+
+# Record fields and the problem files they are stored in
+FILES = {'question': 'problem.tex', 'solution': 'solution.tex'}
+
+
+def _ordered_map(func, items, jobs):
+    """Map func over the argument tuples of items and yield the results
+    in order.
+
+    With jobs > 1 the calls run in a process pool, with at most 2*jobs
+    of them submitted ahead of the results consumed, so that neither the
+    items nor the results pile up in memory.
+    """
+    if jobs == 1:
+        for args in items:
+            yield func(*args)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        try:
+            for args in items:
+                pending.append(pool.submit(func, *args))
+                if len(pending) > 2 * jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+def _iter_array(f, chunk_size):
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ','):
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            buf = f.read(chunk_size)
+            pos = 0
+            eof = not buf
+        if pos == len(buf):
+            raise RuntimeError('Unterminated JSON array of problems')
+        if buf[pos] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise RuntimeError(f'Invalid JSON: {e}')
+            # Read more, growing geometrically so that large records
+            # are not parsed again and again
+            chunk = f.read(max(chunk_size, len(buf) - pos))
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield record
+        pos = end
+
+def _iter_lines(f, first):
+    for number, line in enumerate(f, 1):
+        if number == 1:
+            line = first + line
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise RuntimeError(f'Invalid JSON on line {number}: {e}')
+
+def iter_records(f, chunk_size=1 << 16):
+    """Yield the problem records of a text stream holding either a JSON
+    array or one JSON object per line, reading it incrementally."""
+    first = f.read(1)
+    while first.isspace():
+        first = f.read(1)
+    if first == '[':
+        return _iter_array(f, chunk_size)
+    return _iter_lines(f, first)
+
+def _valid_name(name):
+    return (isinstance(name, str) and name not in ('', '.', '..')
+            and not name.startswith('.')
+            and '/' not in name and '\\' not in name)
+
+def check_record(record):
+    """Return the id of a problem record, or raise a RuntimeError if the
+    record is malformed."""
+    id_ = record.get('id') if isinstance(record, dict) else None
+    if not _valid_name(id_):
+        raise RuntimeError(f'Invalid problem record {str(record):.60}')
+    for field in FILES:
+        if not isinstance(record.get(field, ''), (str, type(None))):
+            raise RuntimeError(f'The {field} of problem {id_} is not text')
+    for attachment in record.get('attachments') or []:
+        if (not isinstance(attachment, (list, tuple)) or len(attachment) != 2
+                or not _valid_name(attachment[0])
+                or not isinstance(attachment[1], str)):
+            raise RuntimeError(f'Invalid attachment {str(attachment):.60} '
+                               f'of problem {id_}')
+    return id_
+
+def problem_record(path):
+    """The record of the problem directory path, with its attachments
+    encoded in base85."""
+    record = {'id': path.name}
+    for field, name in FILES.items():
+        try:
+            record[field] = (path / name).read_text()
+        except FileNotFoundError:
+            record[field] = None
+    attach_path = path / 'attach'
+    if attach_path.is_dir():
+        record['attachments'] = [
+            (attach.name, encode(attach.read_bytes()))
+            for attach in sorted(attach_path.iterdir()) if attach.is_file()]
+    else:
+        record['attachments'] = []
+    return record
+
+def _write_problem(dst, record):
+    dst.mkdir()
+    for field, name in FILES.items():
+        (dst / name).write_text(record.get(field) or '')
+    attachments = record.get('attachments')
+    if attachments:
+        (dst / 'attach').mkdir()
+        try:
+            extract_figs(dst / 'attach', attachments)
+        except ValueError as e:
+            raise RuntimeError(f'Invalid attachment data in problem '
+                               f'{record["id"]}: {e}')
+
+def _write_batch(batch_dir, records):
+    """Write a batch of problem records to batch_dir and return it with
+    their ids. Runs in a worker process when importing in parallel."""
+    batch_dir.mkdir()
+    for record in records:
+        _write_problem(batch_dir / record['id'], record)
+    return batch_dir, [record['id'] for record in records]
+
+def _dump_batch(paths):
+    return [json.dumps(problem_record(path)) for path in paths]
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def import_problems(store, f, jobs=1, batch_size=100):
+    """Import the problem records read from the text stream f.
+
+    Records are read one at a time and written in batches, in parallel
+    if jobs > 1. Each batch is decoded into a staging directory in the
+    store cache, then its problems are moved into place and added to the
+    index in a single transaction. Records whose id is already in the
+    store, or earlier in f, are skipped. Returns an ImportResult.
+    """
+    store.problems_path.mkdir(exist_ok=True)
+    known = set(store.list_problems())
+    added, duplicates = [], []
+
+    def new_records():
+        for record in iter_records(f):
+            id_ = check_record(record)
+            if id_ in known:
+                logger.warning(f'Skipping duplicate problem {id_}')
+                duplicates.append(id_)
+                continue
+            known.add(id_)
+            yield record
+
+    tmp = Path(mkdtemp(prefix='import-', dir=store.get_cache_dir()))
+    try:
+        batches = ((tmp / str(number), batch) for number, batch
+                   in enumerate(_batches(new_records(), batch_size)))
+        for batch_dir, ids in _ordered_map(_write_batch, batches, jobs):
+            for id_ in ids:
+                (batch_dir / id_).rename(store.problems_path / id_)
+            store.index.add_many(ids)
+            added.extend(ids)
+            logger.info(f'Imported {len(added)} problems')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return ImportResult(added, duplicates)
+
+def export_problems(store, f, ids, fmt='jsonl', jobs=1, batch_size=100):
+    """Write the records of the problems ids to the text stream f, as
+    JSON lines or, if fmt is "json", as a JSON array. Problems are read
+    and encoded in batches, in parallel if jobs > 1. Returns the number
+    of problems written."""
+    paths = (store.problems_path / id_ for id_ in ids)
+    batches = ((batch,) for batch in _batches(paths, batch_size))
+    number = 0
+    for lines in _ordered_map(_dump_batch, batches, jobs):
+        for line in lines:
+            if fmt == 'json':
+                f.write(',\n' if number else '[\n')
+                f.write(line)
+            else:
+                f.write(line + '\n')
+            number += 1
+    if fmt == 'json':
+        f.write('\n]\n' if number else '[]\n')
+    return number
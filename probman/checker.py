@@ -1,13 +1,26 @@
+import difflib
+import hashlib
 import logging
+import os
 import re
 from collections import namedtuple, defaultdict
+from functools import partial
 from pathlib import Path
 
+from .trace import TRACER, span, tracing
+
 logger = logging.getLogger(__name__)
 
 ProblemError = namedtuple('ProblemError', ('type', 'description', 'cat'))
 
 
+def _scan_problem(problem, trace=False):
+    """Scan a single problem in a worker process."""
+    with tracing(trace) as tracer:
+        errors, fixes = Checker(None).scan_problem(problem)
+    return errors, fixes, tracer.events if tracer is not None else None
+
+
 
 
 
@@ -19,17 +32,37 @@ class Checker:
                 r'\\input\{(?P<input>.+?)\}',
                ]
 
-    def __init__(self, problem_store):
+    def __init__(self, problem_store, jobs=1, dry_run=False):
         self.problem_store = problem_store
+        self.jobs = jobs
+        self.dry_run = dry_run
         self.errors = defaultdict(list)
+        self.diffs = []
         self.current_problem = None
+        self.pending_fixes = []
+        self.edits = dict()
         self.regex = re.compile('|'.join(self.patterns))
 
+    def get_edit(self, type_):
+        """Return the text of the question or solution as edited by the
+        fixes so far, or None if the file does not exist."""
+        if type_ not in self.edits:
+            try:
+                text = getattr(self.current_problem, f'get_{type_}')()
+            except FileNotFoundError:
+                text = None
+            self.edits[type_] = [text, text]
+        return self.edits[type_][1]
+
+    def set_edit(self, type_, text):
+        self.get_edit(type_)
+        self.edits[type_][1] = text
+
     def replace_in_text(self, str1, str2):
-        text = self.current_problem.get_question()
-        self.current_problem.update_question_text(text.replace(str1, str2))
-        text = self.current_problem.get_solution()
-        self.current_problem.update_solution_text(text.replace(str1, str2))
+        for type_ in ('question', 'solution'):
+            text = self.get_edit(type_)
+            if text is not None:
+                self.set_edit(type_, text.replace(str1, str2))
 
     def _attachment_check(self, type_, value):
         if not self.current_problem.has_attachment(value):
@@ -42,9 +75,8 @@ class Checker:
                                    f'has attachment "{parts[-1]}", but the text'
                                    f' requires "{value}"',
                                    f'missing {type_}: needs rename {parts[-1]}')
-                self.errors[self.current_problem].append(err)
                 yield err
-                self.replace_in_text(value, parts[-1])
+                self.pending_fixes.append(('replace', value, parts[-1]))
             elif parts[0].startswith('\\'):
                 err = ProblemError(f'Missing {type_}',
                                    f'Problem {current.problem_id} '
@@ -52,7 +84,6 @@ class Checker:
                                    'an unexpanded TeX macro',
                                    f'missing {type_}: unexpanded macro '
                                    f'{parts[0]}')
-                self.errors[self.current_problem].append(err)
                 yield err
             else:
                 err = ProblemError(f'Missing {type_}',
@@ -60,7 +91,6 @@ class Checker:
                                    f'requests figure "{value}", which is not '
                                    'found in the attachments for this problem',
                                    f'missing {type_}: file not found {value}')
-                self.errors[self.current_problem].append(err)
                 yield err
 
     def check_figure(self, value):
@@ -88,7 +118,7 @@ class Checker:
                            f'Problem {self.current_problem.problem_id} '
                            f'is missing the {type_} file',
                            f'missing {type_}')
-        getattr(self.current_problem, f'update_{type_}_text')('')
+        self.pending_fixes.append(('create', type_))
             
     def check_problem(self, problem):
         try:
@@ -99,20 +129,140 @@ class Checker:
             yield from self.check_text(problem.get_solution())
         except FileNotFoundError:
             yield from self._file_not_found('solution')
+
+    def scan_problem(self, problem):
+        """Collect the errors and pending fixes for a problem.
+
+        Scanning only reads the problem, so it is safe to run in a worker
+        process; the fixes are applied afterwards by apply_fixes.
+        """
+        self.current_problem = problem
+        self.pending_fixes = []
+        with span('check', problem=problem.problem_id) as args:
+            errors = list(self.check_problem(problem))
+            args.update(errors=len(errors), fixes=len(self.pending_fixes))
+        return errors, self.pending_fixes
+
+    def fix_replace(self, str1, str2):
+        self.replace_in_text(str1, str2)
+
+    def fix_create(self, type_):
+        if self.get_edit(type_) is None:
+            self.set_edit(type_, '')
+
+    @staticmethod
+    def diff(path, old, new):
+        name = os.path.relpath(path)
+        lines = difflib.unified_diff((old or '').splitlines(keepends=True),
+                                     new.splitlines(keepends=True),
+                                     '/dev/null' if old is None
+                                     else f'a/{name}', f'b/{name}')
+        text = ''.join(line if line.endswith('\n') else line + '\n'
+                       for line in lines)
+        if not text:
+            # a new empty file has no lines to diff
+            text = f'--- /dev/null\n+++ b/{name}\n'
+        return text
+
+    def apply_fixes(self, problem, fixes):
+        """Apply the fixes to the text of problem in memory, then write
+        each changed file once, atomically. With dry_run, the unified diff
+        of each change is added to self.diffs instead."""
+        if not fixes:
+            return
+        self.current_problem = problem
+        self.edits = dict()
+        with span('fix', problem=problem.problem_id, fixes=len(fixes)):
+            for kind, *args in fixes:
+                getattr(self, f'fix_{kind}')(*args)
+            for type_, (old, new) in self.edits.items():
+                if new is None or new == old:
+                    continue
+                path = getattr(problem, f'{type_}_path')
+                if self.dry_run:
+                    self.diffs.append(self.diff(path, old, new))
+                else:
+                    logger.info(f'Fixing {path!s}')
+                    getattr(problem, f'update_{type_}_text')(new)
+        self.edits = dict()
         
     def process_problem(self, id_):
         problem = self.problem_store.get_problem(id_)
-        self.current_problem = problem
-        yield from self.check_problem(problem)
+        errors, fixes = self.scan_problem(problem)
+        self.errors[problem].extend(errors)
+        yield from errors
+        self.apply_fixes(problem, fixes)
+
+    def cache_key(self, entry):
+        h = hashlib.sha256('|'.join(self.patterns).encode())
+        h.update(f'{entry.question_hash}:{entry.solution_hash}:'.encode())
+        h.update('/'.join(entry.attachments).encode())
+        return h.hexdigest()
+
+    def _scan_all(self, problems):
+        if self.jobs == 1:
+            yield from map(self.scan_problem, problems)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            tracer = TRACER.get()
+            scan = partial(_scan_problem, trace=tracer is not None)
+            with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                chunksize = max(1, len(problems) // (4 * self.jobs))
+                for errors, fixes, events in pool.map(scan, problems,
+                                                      chunksize=chunksize):
+                    if tracer is not None:
+                        tracer.extend(events)
+                    yield errors, fixes
+
+    def scan(self, ids):
+        """Yield (problem, errors, fixes) for each problem id.
+
+        Problems whose content is unchanged since they were last checked
+        are answered from the cache in the index; the rest are scanned,
+        in parallel if the checker was created with jobs > 1.
+        """
+        to_scan = []
+        keys = dict()
+        for id_ in ids:
+            problem, key, cached = self.lookup(id_)
+            if cached is not None:
+                yield problem, cached, []
+            else:
+                keys[id_] = key
+                to_scan.append(problem)
+        for problem, (errors, fixes) in zip(to_scan, self._scan_all(to_scan)):
+            self.record(problem, keys[problem.problem_id], errors, fixes)
+            yield problem, errors, fixes
+
+    def lookup(self, id_):
+        """Return the problem, its cache key and its cached errors, or None
+        if it must be scanned."""
+        index = self.problem_store.index
+        problem = self.problem_store.get_problem(id_)
+        with span('lookup', problem=id_) as args:
+            key = self.cache_key(index.get_entry(id_))
+            cached = index.get_check_result(id_, key)
+            args['cached'] = cached is not None
+        if cached is not None:
+            cached = [ProblemError(*err) for err in cached]
+        return problem, key, cached
+
+    def record(self, problem, key, errors, fixes):
+        if not fixes:
+            # Fixed problems change on disk, so their result is stale
+            self.problem_store.index.set_check_result(problem.problem_id,
+                                                      key, errors)
           
     def generator(self):
-        process = self.process_problem
         problems = self.problem_store.list_problems()
-        for id_ in problems:
-            yield from process(id_)
+        for problem, errors, fixes in self.scan(problems):
+            self.errors[problem].extend(errors)
+            yield from errors
+            self.apply_fixes(problem, fixes)
 
     def __iter__(self):
         return self.generator()
-        
-            
-                                
+
+    def __aiter__(self):
+        from .aio import check_problems
+        return check_problems(self)
@@ -1,25 +1,36 @@
 
 import logging
-import os
 import sys
-import pkgutil
+import time
 import traceback
-from functools import wraps
+from functools import wraps, update_wrapper
+from contextlib import ExitStack
 from pathlib import Path
-from configparser import ConfigParser
 
 import click
 
-from .problemstore import ProblemStore
-from .utils import make_launcher
-from probman import MAIN_CONFIG, GLOBALS
+from .trace import tracing
+from probman import MAIN_CONFIG, get_globals
 
 logger = logging.getLogger()
 logging.basicConfig(level=logging.WARNING)
 
 CONTEXT_SETTINGS = dict(auto_envvar_prefix='PROBMAN')
 
-pass_prbd = click.make_pass_decorator(ProblemStore)
+def get_store(ctx):
+    """Return the store of the current directory, creating it on first use
+    so that commands which do not need it start quickly."""
+    root = ctx.find_root()
+    if root.obj is None:
+        from .problemstore import ProblemStore
+        root.obj = ProblemStore()
+    return root.obj
+
+def pass_prbd(func):
+    @click.pass_context
+    def wrapper(ctx, *args, **kwargs):
+        return ctx.invoke(func, get_store(ctx), *args, **kwargs)
+    return update_wrapper(wrapper, func)
 
 def error_handling(func):
     @wraps(func)
@@ -32,12 +43,36 @@ def error_handling(func):
             raise click.Abort()
     return wrapper
 
+def trace_options(func):
+    func = click.option('--trace-format', type=click.Choice(('jsonl',
+                                                             'chrome')),
+                        default='jsonl',
+                        help='JSON lines, or Chrome trace-event format')(func)
+    func = click.option('--trace', 'trace_file', default=None,
+                        type=click.Path(dir_okay=False),
+                        help='Write stage timings to this file')(func)
+    return func
+
+def write_trace(tracer, trace_file, trace_format):
+    tracer.write(trace_file, trace_format)
+    slowest = tracer.slowest()
+    if not slowest:
+        return
+    click.echo('Slowest sheets')
+    click.echo(f'{"Sheet":<20}{"Mode":<11}{"Status":<9}{"Passes":>7}'
+               f'{"Time (s)":>10}{"Bytes copied":>14}')
+    for event in slowest:
+        args = event['args']
+        click.echo(f'{args["sheet"]:<20}{args["mode"]:<11}'
+                   f'{args.get("status", ""):<9}{args.get("passes", 0):>7}'
+                   f'{event["dur"] / 1e6:>10.2f}'
+                   f'{tracer.bytes_within(event):>14}')
+
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.option('-v', '--verbose', is_flag=True, envvar='VERBOSE')
 @click.pass_context
 def main(ctx, verbose):
     '''Problem manager main executable.'''
-    ctx.obj = ProblemStore()
     if verbose:
         logger.setLevel(logging.DEBUG)
     
@@ -48,16 +83,27 @@ def main(ctx, verbose):
 @error_handling
 def init(path):
     '''Make a new problemstore in the current directory.'''
+    from .problemstore import ProblemStore
     ProblemStore.create_directory(path)
 
 @main.command()
 @click.option('-m', '--mode',
               type=click.Choice(('questions', 'solutions', 'mixed', 'both')),
               default='questions')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of sheets to build in parallel')
+@click.option('-f', '--force', is_flag=True,
+              help='Rebuild sheets even if their inputs are unchanged')
+@click.option('-c', '--changed', is_flag=True,
+              help='Only build sheets whose problems or includes changed')
+@click.option('-p', '--problem', 'problems', multiple=True,
+              help='Only build sheets that use this problem')
+@trace_options
 @click.argument('sheets', required=False, nargs=-1)
 @pass_prbd
 @error_handling
-def compile(prbd, mode, sheets):
+def compile(prbd, mode, jobs, force, changed, problems, trace_file,
+            trace_format, sheets):
     '''Compile the sheets specified in a sheet specification file.
 
     Args
@@ -67,13 +113,40 @@ def compile(prbd, mode, sheets):
     if not sheets:
         sheets = ('*',)
     prbd.must_exist()
-    compiler = prbd.compile(mode, sheets)
-    length = next(compiler)
-    click.echo('Building sheets')
+    skipped = []
+    failed = []
+    timed_out = []
+    with tracing(trace_file is not None) as tracer:
+        compiler = prbd.compile(mode, sheets, jobs=jobs, force=force,
+                                changed=changed, problems=problems)
+        length = next(compiler)
+        if not length:
+            click.echo('No sheets to build')
+            return
+        click.echo('Building sheets')
     
-    with click.progressbar(compiler, length=length) as bar:
-        for _ in bar:
-            pass
+        with click.progressbar(compiler, length=length) as bar:
+            for result in bar:
+                if result.status == 'skipped':
+                    skipped.append(result)
+                elif result.status == 'failed':
+                    failed.append(result)
+                elif result.status == 'timeout':
+                    timed_out.append(result)
+    if skipped:
+        click.echo(f'Skipped {len(skipped)} unchanged sheet(s): '
+                   + ', '.join(f'{r.sheet.file_name} ({r.mode})'
+                               for r in skipped))
+    if failed:
+        click.echo(f'Failed to build {len(failed)} sheet(s): '
+                   + ', '.join(f'{r.sheet.file_name} ({r.mode})'
+                               for r in failed))
+    if timed_out:
+        click.echo(f'Timed out building {len(timed_out)} sheet(s): '
+                   + ', '.join(f'{r.sheet.file_name} ({r.mode})'
+                               for r in timed_out))
+    if tracer is not None:
+        write_trace(tracer, trace_file, trace_format)
 
 @main.command()
 @click.option('-p', '--problem', type=str, default=None)
@@ -108,19 +181,26 @@ def attach(prbd, problemid, path):
 @main.command()
 @click.option('-e', '--edit', is_flag=True
               )
+@click.option('-u', '--used-by', type=str, default=None,
+              help='List the sheets that use a problem')
 @click.argument('sheet', required=False, default=None, nargs=-1)
 @pass_prbd
 @error_handling
-def sheets(prbd, edit, sheet):
+def sheets(prbd, edit, used_by, sheet):
     """View or edit sheets."""
     prbd.must_exist()
     if edit:
         click.edit(filename=prbd.get_sheet_file())
+    elif used_by:
+        names = prbd.get_used_by(used_by)
+        if names:
+            click.echo(f'Problem {used_by} is used by: {", ".join(names)}')
+        else:
+            click.echo(f'Problem {used_by} is not used by any sheet')
     else:
         if not sheet:
             # view or edit global sheets
             sheets = prbd.get_sheets('*')
-            w, h = click.get_terminal_size()
             click.echo('{:<15}{:<11}{:<14}{}'.format('Sheet name', 
                                                      'Sheet type', 
                                                      'No. questions', 
@@ -175,19 +255,95 @@ def template(prbd, edit):
         click.edit(filename=prbd.get_template_file())
 
 @main.command()
-@click.argument('problem')
+@click.option('-m', '--mode',
+              type=click.Choice(('questions', 'solutions', 'mixed', 'both')),
+              default='questions')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of sheets to build in parallel')
+@click.option('-o', '--open', 'open_pdfs', is_flag=True,
+              help='Open the previews after the first build')
+@click.argument('targets', required=False, nargs=-1)
 @pass_prbd
 @error_handling
-def preview(prbd, problem):
-    """Build and preview a problem."""
+def watch(prbd, mode, jobs, open_pdfs, targets):
+    """Rebuild problem previews and sheets when their sources change.
+
+    Targets are problem ids, to preview, or sheet name patterns. With no
+    targets every sheet is watched.
+    """
     prbd.must_exist()
+    from .watch import Watcher
+    watcher = Watcher(prbd, targets, mode=mode, jobs=jobs)
+    click.echo(f'Watching {prbd.path}, press Ctrl-C to stop')
     try:
-        viewer = GLOBALS.get()['config'].get('system', 'pdfviewer')
+        for round_no, results in enumerate(watcher):
+            for result in results:
+                if result.status == 'built':
+                    click.echo(f'Built {result.pdf}')
+                elif result.status in ('failed', 'timeout'):
+                    click.echo(f'Failed to build {result.sheet.file_name} '
+                               f'({result.mode}): {result.status}')
+                if open_pdfs and round_no == 0 and result.pdf \
+                        and result.mode == 'mixed':
+                    click.launch(str(result.pdf))
+    except KeyboardInterrupt:
+        pass
+
+@main.command()
+@click.option('--prefetch', metavar='PATTERN', default=None,
+              help='Build the previews of the problems matching PATTERN '
+                   'into the preview cache in the background')
+@click.option('--wait', is_flag=True,
+              help='Prefetch in the foreground')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of previews to prefetch in parallel')
+@trace_options
+@click.argument('problem', required=False)
+@pass_prbd
+@error_handling
+def preview(prbd, prefetch, wait, jobs, trace_file, trace_format, problem):
+    """Build and preview a problem.
+
+    Previews are kept in a cache, so a problem that has not changed since
+    it was last previewed opens straight away.
+    """
+    prbd.must_exist()
+    if prefetch is not None:
+        if not wait:
+            import subprocess
+            log = prbd.get_cache_dir() / 'prefetch.log'
+            with log.open('ab') as f:
+                proc = subprocess.Popen(
+                    [sys.executable, '-c', 'from probman.cli import main; '
+                     'main()', 'preview', '--prefetch', prefetch, '--wait',
+                     '--jobs', str(jobs)],
+                    cwd=prbd.path, stdin=subprocess.DEVNULL, stdout=f,
+                    stderr=subprocess.STDOUT, start_new_session=True)
+            click.echo(f'Prefetching previews in the background '
+                       f'(pid {proc.pid}), see {log}')
+            return
+        built = failed = 0
+        for id_, pdf in prbd.prefetch_previews(prefetch, jobs=jobs):
+            if pdf:
+                built += 1
+            else:
+                failed += 1
+                click.echo(f'Failed to build the preview of {id_}')
+        click.echo(f'Cached {built} previews')
+        return
+    if problem is None:
+        raise click.UsageError('Missing argument PROBLEM')
+    from .utils import make_launcher
+    viewer = get_globals()['config'].get('system', 'pdfviewer',
+                                         fallback=None)
+    if viewer:
         logger.debug(f'Using viewer {viewer} specified in config')
         launcher = make_launcher(viewer)
-    except KeyError:
-        viewer=None
-    with prbd.preview(problem) as pdf:
+    with ExitStack() as stack:
+        with tracing(trace_file is not None) as tracer:
+            pdf = stack.enter_context(prbd.preview(problem))
+        if tracer is not None:
+            write_trace(tracer, trace_file, trace_format)
         if viewer:
             launcher(str(pdf))
         else:
@@ -195,14 +351,57 @@ def preview(prbd, problem):
             click.pause()
 
 @main.command()
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of problems to check in parallel')
+@click.option('-n', '--dry-run', is_flag=True,
+              help='Show the automatic fixes as a diff instead of '
+                   'applying them')
+@trace_options
 @pass_prbd
-def check(prbd):
+def check(prbd, jobs, dry_run, trace_file, trace_format):
     """Check all problems for errors.
     """
     prbd.must_exist()
     from .checker import Checker
-    for err in Checker(prbd):
-        click.echo(err.description)
+    with tracing(trace_file is not None) as tracer:
+        checker = Checker(prbd, jobs=jobs, dry_run=dry_run)
+        for err in checker:
+            click.echo(err.description)
+        for diff in checker.diffs:
+            click.echo(diff, nl=False)
+    if tracer is not None:
+        tracer.write(trace_file, trace_format)
+
+@main.command()
+@pass_prbd
+@error_handling
+def reindex(prbd):
+    """Rebuild the problem index from the filesystem."""
+    prbd.must_exist()
+    number = prbd.reindex()
+    click.echo(f'Indexed {number} problems')
+
+@main.command()
+@click.option('--macros', is_flag=True, help='Also match macro names')
+@click.option('--math', is_flag=True, help='Also match inside formulas')
+@click.option('-n', '--limit', type=click.IntRange(min=1), default=20)
+@click.option('--cached', is_flag=True,
+              help='Do not check for changed problems before searching')
+@click.argument('query', nargs=-1, required=True)
+@pass_prbd
+@error_handling
+def search(prbd, macros, math, limit, cached, query):
+    """Search problem text.
+
+    QUERY supports AND, OR, NOT, "phrases" and prefix* searches. Results
+    are ranked best match first.
+    """
+    prbd.must_exist()
+    hits = prbd.search(' '.join(query), macros=macros, math=math,
+                       limit=limit, update=not cached)
+    for hit in hits:
+        snippet = ' '.join(hit.snippet.split())
+        click.echo(f'{hit.problem_id:15} {snippet}')
 
 @main.command()
 @pass_prbd
@@ -212,30 +411,101 @@ def open(prbd):
     click.launch(str(prbd.path))
 
 @main.command()
-@click.option('-o', '--overwrite', is_flag=True)
-@click.argument('path', type=click.Path())
+@click.option('-o', '--overwrite', is_flag=True,
+              help='Replace problems that differ from the merged ones')
+@click.argument('path', type=click.Path(exists=True))
 @pass_prbd
 @error_handling
 def merge(prbd, overwrite, path):
     """Merge problems from another store or archive."""
-    from .utils import check_is_archive
-    if check_is_archive(path):
-        from .utils import decompress
-        with decompress(path) as store:
-            prbd.merge_other(store, overwrite=overwrite)
-    else:
-        prbd.merge_other(path, overwrite=overwrite)
-        
+    prbd.must_exist()
+    result = prbd.merge_other(path, overwrite=overwrite)
+    click.echo(f'Added {len(result.added)}, updated {len(result.updated)}, '
+               f'{len(result.unchanged)} unchanged')
+    if result.conflicts:
+        click.echo(f'{len(result.conflicts)} problems differ and were not '
+                   'merged (use --overwrite to replace them):')
+        for id_ in result.conflicts:
+            click.echo(f'    {id_}')
+
 @main.command()
-@click.option('-m', '--mode', type=click.Choice(('targz', 'tarxz', 'zip')))
+@click.option('-m', '--mode', type=click.Choice(('targz', 'tarxz', 'zip')),
+              default='targz')
 @click.option('-o', '--output', type=click.Path(), default=None)
+@click.option('-b', '--base', type=click.Path(exists=True), default=None,
+              help='Only include problems changed since this archive '
+                   'or archive manifest')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of threads compressing tar archives')
 @pass_prbd
 @error_handling
-def archive(prbd, mode, output):
+def archive(prbd, mode, output, base, jobs):
     """Compress the store into an archive."""
-    from .utils import compress
+    prbd.must_exist()
+    from .archive import write_archive, read_manifest
     if not output:
-        output = prbd.path / 'archive'
-    arch = compress(prbd.get_problem_dir(), output, mode)
-    click.echo(f'Archive created in {arch}')
+        output = prbd.path / time.strftime('archive-%Y%m%d-%H%M%S')
+    base_manifest = read_manifest(base) if base else None
+    arch, manifest = write_archive(prbd, output, mode, base=base_manifest,
+                                   jobs=jobs)
+    click.echo(f'Archive created in {arch} with '
+               f'{len(manifest["included"])} problems'
+               + (f', {len(manifest["removed"])} removed'
+                  if base else ''))
 
+@main.command()
+@click.argument('archives', nargs=-1, required=True,
+                type=click.Path(exists=True))
+@pass_prbd
+@error_handling
+def restore(prbd, archives):
+    """Restore a full archive followed by its incremental archives."""
+    prbd.must_exist()
+    from .archive import restore_archives
+    written, removed = restore_archives(prbd, [Path(a) for a in archives])
+    click.echo(f'Restored {written} problems, removed {removed}')
+
+@main.command('import')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of processes decoding and writing problems')
+@click.option('-b', '--batch-size', type=click.IntRange(min=1), default=100,
+              help='Number of problems written and indexed at once')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@pass_prbd
+@error_handling
+def import_(prbd, jobs, batch_size, file):
+    """Import problems from a JSON lines or JSON file.
+
+    Each record has an id, the question and solution text, and a list of
+    [name, data] attachments, with the data encoded in base85. Use - to
+    read from standard input.
+    """
+    prbd.must_exist()
+    result = prbd.import_problems(file, jobs=jobs, batch_size=batch_size)
+    click.echo(f'Imported {len(result.added)} problems')
+    if result.duplicates:
+        click.echo(f'{len(result.duplicates)} problems already exist and '
+                   'were not imported:')
+        for id_ in result.duplicates:
+            click.echo(f'    {id_}')
+
+@main.command()
+@click.option('-o', '--output', type=click.File('w', encoding='utf-8'),
+              default='-')
+@click.option('-f', '--format', 'fmt', type=click.Choice(('jsonl', 'json')),
+              default=None,
+              help='Output format, by default json if the output file ends '
+                   'in .json, jsonl otherwise')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of processes reading and encoding problems')
+@click.argument('problems', nargs=-1)
+@pass_prbd
+@error_handling
+def export(prbd, output, fmt, jobs, problems):
+    """Export problems matching PROBLEMS, or all of them, in the format
+    read by import."""
+    prbd.must_exist()
+    if fmt is None:
+        fmt = 'json' if output.name.endswith('.json') else 'jsonl'
+    number = prbd.export_problems(output, pats=problems, fmt=fmt, jobs=jobs)
+    logger.info(f'Exported {number} problems')
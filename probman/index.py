@@ -0,0 +1,242 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+
+from .utils import hash_file, digest_files
+
+logger = logging.getLogger(__name__)
+
+IndexEntry = namedtuple('IndexEntry', ('problem_id', 'question_hash',
+                                       'solution_hash', 'attachments',
+                                       'content_hash'))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS problems (
+    id TEXT PRIMARY KEY,
+    question_stat TEXT,
+    question_hash TEXT,
+    solution_stat TEXT,
+    solution_hash TEXT,
+    content_hash TEXT
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    problem_id TEXT REFERENCES problems(id) ON DELETE CASCADE,
+    name TEXT,
+    stat TEXT,
+    hash TEXT,
+    PRIMARY KEY (problem_id, name)
+);
+CREATE TABLE IF NOT EXISTS checks (
+    problem_id TEXT PRIMARY KEY REFERENCES problems(id) ON DELETE CASCADE,
+    key TEXT,
+    errors TEXT
+);
+'''
+
+
+def _stat_key(path):
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return f'{st.st_mtime_ns}:{st.st_size}'
+
+
+def _locked(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ProblemIndex:
+    """Persistent index of the problems in a store.
+
+    The set of problem ids is refreshed from the problems directory only
+    when its mtime changes. File hashes for a problem are refreshed
+    lazily, when the entry is requested and the mtime or size of one of
+    its files has changed.
+    """
+
+    refresh_interval = 1.0
+
+    def __init__(self, db_path, problems_path):
+        self.db_path = db_path
+        self.problems_path = problems_path
+        # The async API queries the index from worker threads, so the
+        # connection is shared and every access holds self.lock
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+        self.last_refresh = None
+
+    @_locked
+    def close(self):
+        self.db.close()
+
+    def _get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (key, value))
+
+    @_locked
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if (not force and self.last_refresh is not None
+                and now - self.last_refresh < self.refresh_interval):
+            return
+        self.last_refresh = now
+        stat = _stat_key(self.problems_path)
+        if not force and stat == self._get_meta('problems_stat'):
+            return
+        logger.debug(f'Refreshing problem index from {self.problems_path}')
+        if stat is None:
+            on_disk = set()
+        else:
+            on_disk = {d.name for d in self.problems_path.iterdir()
+                       if d.is_dir()}
+        indexed = {row[0] for row in
+                   self.db.execute('SELECT id FROM problems')}
+        with self.db:
+            self.db.executemany('INSERT INTO problems (id) VALUES (?)',
+                                ((id_,) for id_ in on_disk - indexed))
+            self.db.executemany('DELETE FROM problems WHERE id = ?',
+                                ((id_,) for id_ in indexed - on_disk))
+            self._set_meta('problems_stat', stat)
+
+    @_locked
+    def rebuild(self):
+        with self.db:
+            self.db.execute('DELETE FROM checks')
+            self.db.execute('DELETE FROM attachments')
+            self.db.execute('DELETE FROM problems')
+            self._set_meta('problems_stat', None)
+        self.refresh(force=True)
+        ids = self.list_problems()
+        for id_ in ids:
+            self.get_entry(id_)
+        return len(ids)
+
+    @_locked
+    def list_problems(self):
+        self.refresh()
+        return [row[0] for row in
+                self.db.execute('SELECT id FROM problems ORDER BY id')]
+
+    @_locked
+    def has_problem(self, id_):
+        self.refresh()
+        row = self.db.execute('SELECT 1 FROM problems WHERE id = ?',
+                              (id_,)).fetchone()
+        return row is not None
+
+    @_locked
+    def add(self, id_):
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO problems (id) VALUES (?)',
+                            (id_,))
+            self._set_meta('problems_stat', _stat_key(self.problems_path))
+
+    @_locked
+    def add_many(self, ids):
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO problems (id) '
+                                'VALUES (?)', ((id_,) for id_ in ids))
+            self._set_meta('problems_stat', _stat_key(self.problems_path))
+
+    @_locked
+    def remove(self, id_):
+        with self.db:
+            self.db.execute('DELETE FROM problems WHERE id = ?', (id_,))
+            self._set_meta('problems_stat', _stat_key(self.problems_path))
+
+    def _refresh_file(self, path, old_stat, old_hash):
+        stat = _stat_key(path)
+        if stat is None:
+            return None, None
+        if stat == old_stat and old_hash is not None:
+            return stat, old_hash
+        return stat, hash_file(path)
+
+    def _refresh_attachments(self, id_, attach_path):
+        old = {name: (stat, hash_) for name, stat, hash_ in
+               self.db.execute('SELECT name, stat, hash FROM attachments '
+                               'WHERE problem_id = ?', (id_,))}
+        new = dict()
+        if attach_path.exists():
+            for path in attach_path.iterdir():
+                if not path.is_file():
+                    continue
+                new[path.name] = self._refresh_file(path,
+                                                    *old.get(path.name,
+                                                             (None, None)))
+        if new != old:
+            self.db.execute('DELETE FROM attachments WHERE problem_id = ?',
+                            (id_,))
+            self.db.executemany('INSERT INTO attachments VALUES (?, ?, ?, ?)',
+                                ((id_, name, stat, hash_)
+                                 for name, (stat, hash_) in new.items()))
+        return {name: hash_ for name, (_, hash_) in new.items()}
+
+    @_locked
+    def get_entry(self, id_):
+        """Return the up to date IndexEntry for a problem, or None."""
+        row = self.db.execute('SELECT question_stat, question_hash, '
+                              'solution_stat, solution_hash, content_hash '
+                              'FROM problems WHERE id = ?', (id_,)).fetchone()
+        if row is None:
+            return None
+        q_stat, q_hash, s_stat, s_hash, content_hash = row
+        path = self.problems_path / id_
+        with self.db:
+            q_stat, q_hash = self._refresh_file(path / 'problem.tex',
+                                                q_stat, q_hash)
+            s_stat, s_hash = self._refresh_file(path / 'solution.tex',
+                                                s_stat, s_hash)
+            attachments = self._refresh_attachments(id_, path / 'attach')
+            files = [(f'attach/{name}', hash_)
+                     for name, hash_ in attachments.items()]
+            if q_hash is not None:
+                files.append(('problem.tex', q_hash))
+            if s_hash is not None:
+                files.append(('solution.tex', s_hash))
+            new_row = (q_stat, q_hash, s_stat, s_hash, digest_files(files))
+            if new_row != row:
+                self.db.execute('UPDATE problems SET question_stat = ?, '
+                                'question_hash = ?, solution_stat = ?, '
+                                'solution_hash = ?, content_hash = ? '
+                                'WHERE id = ?', (*new_row, id_))
+            content_hash = new_row[-1]
+        return IndexEntry(id_, q_hash, s_hash, tuple(sorted(attachments)),
+                          content_hash)
+
+    @_locked
+    def content_hash(self, id_):
+        entry = self.get_entry(id_)
+        return entry.content_hash if entry else None
+
+    @_locked
+    def get_check_result(self, id_, key):
+        row = self.db.execute('SELECT errors FROM checks WHERE problem_id = ? '
+                              'AND key = ?', (id_, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @_locked
+    def set_check_result(self, id_, key, errors):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO checks VALUES (?, ?, ?)',
+                            (id_, key, json.dumps(errors)))
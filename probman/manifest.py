@@ -0,0 +1,92 @@
+import hashlib
+import logging
+
+from .utils import hash_file, read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+
+class BuildManifest:
+    """Record of the inputs of every sheet built into the store.
+
+    A sheet is only rebuilt when the hash of its inputs differs from the
+    one recorded for the previous successful build. The hashes of the
+    problems and includes are also kept per sheet, so that changed sheets
+    can be found without rendering them.
+    """
+
+    def __init__(self, path, hash_problem=None):
+        self.path = path
+        self.hash_problem = hash_problem
+        self.entries = read_json(path, default={})
+        self.file_hashes = dict()
+        self.problem_hashes = dict()
+        self.dirty = False
+
+    @staticmethod
+    def key(mode, sheet):
+        return f'{mode}:{sheet.file_name}'
+
+    def _hash_file(self, path):
+        if path not in self.file_hashes:
+            self.file_hashes[path] = hash_file(path)
+        return self.file_hashes[path]
+
+    def _hash_problem(self, problem):
+        if problem.problem_id not in self.problem_hashes:
+            if self.hash_problem is not None:
+                digest = self.hash_problem(problem.problem_id)
+            else:
+                try:
+                    digest = problem.content_hash()
+                except OSError:
+                    digest = None
+            self.problem_hashes[problem.problem_id] = digest
+        return self.problem_hashes[problem.problem_id]
+
+    def includes_hash(self, includes):
+        h = hashlib.sha256()
+        for incl in sorted(includes):
+            h.update(f'{incl.name}:{self._hash_file(incl)}\n'.encode())
+        return h.hexdigest()
+
+    def sheet_inputs(self, sheet, includes):
+        return {'problems': {problem.problem_id: self._hash_problem(problem)
+                             for problem, _ in sheet.problems},
+                'includes': self.includes_hash(includes)}
+
+    def sheet_hash(self, sheet, text, includes, engine_options):
+        """Return the hash of the inputs of a sheet and the inputs."""
+        inputs = self.sheet_inputs(sheet, includes)
+        h = hashlib.sha256(text.encode())
+        for id_, digest in sorted(inputs['problems'].items()):
+            h.update(f'problem:{id_}:{digest}\n'.encode())
+        h.update(f'includes:{inputs["includes"]}\n'.encode())
+        for k, v in sorted(engine_options.items()):
+            h.update(f'engine:{k}={v}\n'.encode())
+        return h.hexdigest(), inputs
+
+    def is_current(self, key, digest, pdf):
+        entry = self.entries.get(key)
+        return (isinstance(entry, dict) and entry.get('hash') == digest
+                and pdf.exists())
+
+    def is_changed(self, key, sheet, includes):
+        """Whether the problems or includes of a sheet changed since the
+        last successful build, without rendering the sheet."""
+        entry = self.entries.get(key)
+        if not isinstance(entry, dict):
+            return True
+        inputs = self.sheet_inputs(sheet, includes)
+        return (inputs['includes'] != entry.get('includes')
+                or inputs['problems'] != entry.get('problems'))
+
+    def record(self, key, digest, inputs):
+        self.entries[key] = dict(inputs, hash=digest)
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            logger.debug(f'Writing build manifest {self.path!s}')
+            write_json(self.path, self.entries)
+            self.dirty = False
@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import shutil
+from pathlib import Path
+from tempfile import mkdtemp
+from collections import namedtuple, defaultdict
+
+from .archive import ArchiveReader
+from .utils import digest_files
+
+logger = logging.getLogger(__name__)
+
+MergeResult = namedtuple('MergeResult',
+                         ('added', 'updated', 'unchanged', 'conflicts'))
+
+
+def _is_problem_file(rel):
+    parts = rel.split('/')
+    return (rel in ('problem.tex', 'solution.tex')
+            or (len(parts) == 2 and parts[0] == 'attach'))
+
+
+class StoreSource:
+    """Problems of another store directory.
+
+    The other store's configuration is read into a parser of its own,
+    only to find its problems directory, so that the settings of the
+    current store are left alone.
+    """
+
+    def __init__(self, path):
+        import pkgutil
+        from configparser import ConfigParser
+        path = Path(path)
+        config = ConfigParser()
+        config.read_string(pkgutil.get_data('probman', 'data/config')
+                           .decode())
+        config.read(path / '.prob' / 'config')
+        self.problems_path = path / config['paths']['problems_path']
+        if not self.problems_path.is_dir():
+            raise RuntimeError(f'No problems found in {path}')
+
+    def _problems(self):
+        from .sheets import Problem
+        for path in sorted(self.problems_path.iterdir()):
+            if path.is_dir() and not path.name.startswith('.'):
+                yield Problem(path.name, path)
+
+    def hashes(self):
+        return {problem.problem_id: problem.content_hash()
+                for problem in self._problems()}
+
+    def members(self, ids):
+        for problem in self._problems():
+            if problem.problem_id not in ids:
+                continue
+            for path in problem.list_files():
+                rel = path.relative_to(problem.path).as_posix()
+                yield (problem.problem_id, rel,
+                       (lambda p=path: open(p, 'rb')))
+
+
+class ArchiveSource:
+    """Problems of a tar or zip archive, read without extracting it.
+
+    Archives written by probman carry the content hash of every problem
+    in their manifest, so only the members of the problems that are
+    actually merged are read. Other archives are hashed in a first pass
+    over their members.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with ArchiveReader(self.path) as reader:
+            self.manifest = reader.manifest
+
+    def hashes(self):
+        if self.manifest is not None:
+            state = self.manifest['state']
+            return {id_: state[id_] for id_ in self.manifest['included']}
+        logger.info(f'{self.path} has no manifest, hashing its contents')
+        files = defaultdict(list)
+        with ArchiveReader(self.path) as reader:
+            for id_, rel, opener in reader.problem_members():
+                if not _is_problem_file(rel):
+                    continue
+                h = hashlib.sha256()
+                with opener() as f:
+                    for chunk in iter(lambda: f.read(1 << 16), b''):
+                        h.update(chunk)
+                files[id_].append((rel, h.hexdigest()))
+        return {id_: digest_files(pairs) for id_, pairs in files.items()}
+
+    def members(self, ids):
+        with ArchiveReader(self.path) as reader:
+            for id_, rel, opener in reader.problem_members():
+                if id_ in ids:
+                    yield id_, rel, opener
+
+
+def open_source(path):
+    path = Path(path)
+    if path.is_dir():
+        return StoreSource(path)
+    elif path.is_file():
+        return ArchiveSource(path)
+    raise RuntimeError(f'Cannot merge from {path}, no such store or archive')
+
+
+def plan_merge(store, theirs, overwrite=False):
+    """Compare the content hashes of both sides and return a MergeResult
+    of problem ids.
+
+    Only the problems present on both sides are hashed in store, and
+    problems with identical contents are left alone. Problems that differ
+    are conflicts unless overwrite is set, in which case they are updated.
+    """
+    ours = set(store.list_problems())
+    added, updated, unchanged, conflicts = [], [], [], []
+    for id_, digest in sorted(theirs.items()):
+        if id_ not in ours:
+            added.append(id_)
+        elif store.index.content_hash(id_) == digest:
+            unchanged.append(id_)
+        elif overwrite:
+            updated.append(id_)
+        else:
+            conflicts.append(id_)
+    return MergeResult(added, updated, unchanged, conflicts)
+
+
+def _install(store, staged, id_):
+    dst = store.problems_path / id_
+    if dst.exists():
+        old = staged.parent / f'{id_}.old'
+        dst.rename(old)
+        staged.rename(dst)
+        shutil.rmtree(old)
+    else:
+        staged.rename(dst)
+    store.index.add(id_)
+
+
+def merge_problems(store, source, overwrite=False):
+    """Merge the problems of source into store.
+
+    The files of the new and updated problems are written to a staging
+    directory in the store cache, and each problem is then moved into
+    place as a whole. Returns the MergeResult.
+    """
+    result = plan_merge(store, source.hashes(), overwrite=overwrite)
+    ids = set(result.added + result.updated)
+    if not ids:
+        return result
+    store.problems_path.mkdir(exist_ok=True)
+    tmp = Path(mkdtemp(prefix='merge-', dir=store.get_cache_dir()))
+    try:
+        staging = tmp / 'problems'
+        for id_ in ids:
+            (staging / id_).mkdir(parents=True)
+        for id_, rel, opener in source.members(ids):
+            if not _is_problem_file(rel):
+                logger.warning(f'Not merging unexpected file {rel} '
+                               f'of {id_}')
+                continue
+            dst = staging / id_ / rel
+            dst.parent.mkdir(exist_ok=True)
+            logger.debug(f'Merging {id_}/{rel}')
+            with opener() as src, open(dst, 'wb') as f:
+                shutil.copyfileobj(src, f)
+        for id_ in sorted(ids):
+            _install(store, staging / id_, id_)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return result
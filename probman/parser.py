@@ -1,7 +1,9 @@
 
+import hashlib
 import logging
 import re
 from .sheets import Sheet, Problem
+from .utils import read_json, write_json
 
 LINERE = re.compile(r'((?P<sheet>\w+)(\s+(?P<sheet_type>\w+))?\s*|'
                     r'(?P<indent>\s+)?((?P<key>\w+)\s*=\s*)?(?P<value>.*))$')
@@ -13,6 +15,38 @@ def default_mark_formatter(mark):
     return f'''\\par\\null\\hfill\\textbf{{[{str(mark) + " mark"
                                              if mark else " marks"}]}}'''
 
+def read_sheet_cache(path, ext, cache_path):
+    """Return the parsed sheet file path/ext as a dictionary.
+
+    The "sheets" entry holds the sheet specifications and "used_by" maps
+    each problem id to the names of the sheets that use it. The result is
+    cached in cache_path, keyed by the mtime and size of the sheet file
+    and by the hash of its contents, so the file is only reparsed when it
+    has really changed.
+    """
+    sheet_path = path / ext
+    st = sheet_path.stat()
+    stat = f'{st.st_mtime_ns}:{st.st_size}'
+    cached = read_json(cache_path, default={})
+    if cached.get('stat') == stat:
+        return cached
+    digest = hashlib.sha256(sheet_path.read_bytes()).hexdigest()
+    if cached.get('hash') != digest:
+        logger.debug(f'Parsing sheet file {sheet_path!s}')
+        with SheetParser(path, ext) as parser:
+            sheets = [sheet.to_spec() for sheet in parser.parse()]
+        used_by = dict()
+        for spec in sheets:
+            for id_, _ in spec['problems']:
+                names = used_by.setdefault(id_, [])
+                if spec['file_name'] not in names:
+                    names.append(spec['file_name'])
+        cached.update(sheets=sheets, used_by=used_by)
+    cached.update(stat=stat, hash=digest)
+    write_json(cache_path, cached)
+    return cached
+
+
 class SheetParser:
 
     def __init__(self, path, ext):
@@ -74,14 +108,15 @@ class SheetParser:
         id_ = match.group('problem_id')
         if id_ is None:
             raise SyntaxError(f'Invalid syntax in {problem_text}')
-        self.current.problems.append((Problem(id_, self.problem_dir / id_), mark))
+        self.current.problem_refs.append((id_, mark))
 
     def new_sheet(self, sheet_name, sheet_type):
         logger.debug(f'Creating new sheet with name {sheet_name}')
         metadata = dict()
         metadata.update(self.global_metadata)
         current = self.current
-        self.current = Sheet(sheet_name, sheet_type, metadata, [])
+        self.current = Sheet(sheet_name, sheet_type, metadata, [],
+                             self.problem_dir)
         return current
 
     def parse_line(self, line):
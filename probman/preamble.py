@@ -0,0 +1,145 @@
+import hashlib
+import logging
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from .utils import hash_file, stage_file, run_limited, BuildTimeout
+
+logger = logging.getLogger(__name__)
+
+BEGIN_DOCUMENT = '\\begin{document}'
+
+
+def split_preamble(text):
+    idx = text.find(BEGIN_DOCUMENT)
+    if idx < 0:
+        return text, ''
+    return text[:idx], text[idx:]
+
+
+def common_lines(first, second):
+    lines = []
+    for a, b in zip(first.splitlines(keepends=True),
+                    second.splitlines(keepends=True)):
+        if a != b:
+            break
+        lines.append(a)
+    return ''.join(lines)
+
+
+class FormatCache:
+    """Precompiled formats for the static part of the sheet preambles.
+
+    The static preamble of a sheet is the run of leading lines that it
+    shares with the template rendered without any sheet data. It is
+    dumped once into a format with mylatexformat, and the sheet skips it
+    at load time through an \\endofdump marker. Dumping a format runs
+    within limits, like the engine passes.
+
+    Format names start with a hash of the engine version, the includes
+    and the skeleton, which a format is only valid for; formats with any
+    other prefix are deleted when a new one is built.
+    """
+
+    def __init__(self, path, template, includes, engine='pdflatex',
+                 limits=None):
+        self.path = path
+        self.engine = engine
+        self.limits = limits
+        self.includes = list(includes)
+        self.formats = dict()
+        try:
+            skeleton = template.render(problems=[],
+                                       include_problems=True,
+                                       include_solutions=True)
+        except Exception as e:
+            logger.warning(f'Cannot render template skeleton: {e}')
+            skeleton = ''
+        self.skeleton, _ = split_preamble(skeleton)
+        self._prefix = None
+
+    def engine_version(self):
+        try:
+            ck = run_limited([self.engine, '--version'], limits=self.limits)
+        except (OSError, BuildTimeout) as e:
+            logger.warning(f'Cannot get the {self.engine} version: {e}')
+            return ''
+        return ck.stdout.decode(errors='replace')
+
+    @property
+    def prefix(self):
+        if self._prefix is None:
+            h = hashlib.sha256(f'{self.engine}\n'.encode())
+            h.update(self.engine_version().encode())
+            for incl in sorted(self.includes):
+                h.update(f'{incl.name}:{hash_file(incl)}\n'.encode())
+            h.update(self.skeleton.encode())
+            self._prefix = h.hexdigest()[:8]
+        return self._prefix
+
+    def _key(self, static):
+        h = hashlib.sha256(static.encode())
+        return f'{self.prefix}-{h.hexdigest()[:16]}'
+
+    def _prune(self):
+        for fmt in self.path.glob('*.fmt'):
+            if not fmt.name.startswith(f'{self.prefix}-'):
+                logger.debug(f'Removing stale preamble format {fmt.name}')
+                fmt.unlink(missing_ok=True)
+
+    def _build(self, key, static):
+        fmt = self.path / f'{key}.fmt'
+        logger.info(f'Building preamble format {fmt.name}')
+        with TemporaryDirectory(dir=self.path) as tmp:
+            wd = Path(tmp)
+            for incl in self.includes:
+                stage_file(incl, wd / incl.name)
+            (wd / f'{key}.tex').write_text(static + '\\endofdump\n'
+                                           + BEGIN_DOCUMENT
+                                           + '\n\\end{document}\n')
+            ck = run_limited([self.engine, '-ini',
+                              '--interaction=nonstopmode', f'-jobname={key}',
+                              f'&{self.engine}', 'mylatexformat.ltx',
+                              f'{key}.tex'],
+                             cwd=wd, limits=self.limits)
+            built = wd / fmt.name
+            if ck.returncode or not built.exists():
+                logger.warning(f'Building preamble format {fmt.name} failed, '
+                               'compiling without it')
+                logger.debug(ck.stdout.decode(errors='replace'))
+                return None
+            built.replace(fmt)
+        self._prune()
+        return fmt
+
+    def get_format(self, static):
+        key = self._key(static)
+        if key not in self.formats:
+            fmt = self.path / f'{key}.fmt'
+            try:
+                self.formats[key] = (fmt if fmt.exists()
+                                     else self._build(key, static))
+            except BuildTimeout as e:
+                # Remembered, so the sheets sharing this preamble do not
+                # each wait for the timeout again
+                self.formats[key] = e
+        if isinstance(self.formats[key], BuildTimeout):
+            raise self.formats[key]
+        return self.formats[key]
+
+    def prepare(self, text):
+        """Return the text to compile and the format to compile it with.
+
+        The format is None if the sheet has no usable static preamble or
+        the format could not be built, in which case the text is returned
+        unchanged. Raises BuildTimeout if building the format timed out.
+        """
+        preamble, body = split_preamble(text)
+        static = common_lines(self.skeleton, preamble)
+        if '\\documentclass' not in static:
+            return text, None
+        fmt = self.get_format(static)
+        if fmt is None:
+            return text, None
+        return (static + '\\endofdump\n' + preamble[len(static):] + body,
+                fmt)
@@ -0,0 +1,62 @@
+import logging
+import os
+
+from .utils import publish_file
+
+logger = logging.getLogger(__name__)
+
+
+class PreviewCache:
+    """Size capped cache of preview PDFs, named by the hash of their inputs.
+
+    A hit refreshes the mtime of the PDF, and when the cache grows over
+    max_bytes the least recently used previews are evicted first.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def pdf_path(self, key):
+        return self.path / f'{key}.pdf'
+
+    def get(self, key):
+        pdf = self.pdf_path(key)
+        try:
+            os.utime(pdf)
+        except FileNotFoundError:
+            return None
+        logger.debug(f'Preview cache hit {pdf.name}')
+        return pdf
+
+    def put(self, key, pdf):
+        cached = self.pdf_path(key)
+        publish_file(pdf, cached)
+        self.evict(keep=cached)
+        return cached
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.pdf'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, entry.path))
+            total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if keep is not None and path == str(keep):
+                continue
+            logger.debug(f'Evicting preview {os.path.basename(path)}')
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
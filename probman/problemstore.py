@@ -2,33 +2,141 @@
 import shutil
 import logging
 import re
+import threading
 from fnmatch import fnmatch
 from pathlib import Path
 from functools import wraps
 from string import Template
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkdtemp
 from configparser import ConfigParser
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
+from collections import namedtuple
 
-from .utils import tex_compile
-from .sheets import Problem
-from probman import MAIN_CONFIG, GLOBALS
+from .utils import (tex_compile, stage_file, hash_file, digest_files, Limits,
+                    BuildTimeout)
+from .sheets import Problem, Sheet, TEXT_CACHE
+from .trace import TRACER, span, tracing
+from probman import MAIN_CONFIG, get_globals
 
 logger = logging.getLogger(__name__)
 
+BuildResult = namedtuple('BuildResult',
+                         ('sheet', 'mode', 'pdf', 'status', 'passes', 'trace'),
+                         defaults=(None,))
+
+# The variants of a sheet to build in build_dir, and the manifest digests
+# to record for them once built
+BuildTask = namedtuple('BuildTask', ('sheet', 'label', 'variants',
+                                     'build_dir', 'includes',
+                                     'engine_options', 'digests'))
+
 def _ensure_exists(path):
     path.mkdir(exist_ok=True)
 
+def _as_bool(value):
+    return ConfigParser.BOOLEAN_STATES.get(str(value).lower(), False)
+
+def _compile_variant(sheet, mode, target, output_to, engine_options):
+    try:
+        pdf, passes = sheet.build(target, output_to, **engine_options)
+    except BuildTimeout as e:
+        logger.warning(f'{sheet.file_name} ({mode}): {e}')
+        return BuildResult(sheet, mode, None, 'timeout', 0)
+    except RuntimeError as e:
+        logger.warning(e)
+        return BuildResult(sheet, mode, None, 'failed', 0)
+    logger.info(f'Built {sheet.file_name} ({mode}) in {passes} pass(es)')
+    return BuildResult(sheet, mode, pdf, 'built', passes)
+
+def stage_build(sheet, variants, build_dir, includes, engine_options):
+    """Stage the includes, formats and attachments of sheet in build_dir
+    and write the source of each (mode, text, output_to, fmt) variant.
+
+    Returns the (sheet, mode, target, output_to, engine options) of each
+    variant to compile. Files that have to be copied are copied once per
+    build into a pool shared by the build directories of all sheets.
+    """
+    pool = build_dir.parent / '.staged'
+    pool.mkdir(exist_ok=True)
+    with span('stage', what='includes') as args:
+        args['bytes'] = sum(stage_file(incl, build_dir / incl.name,
+                                       pool=pool)
+                            for incl in includes)
+        for fmt in {fmt for *_, fmt in variants if fmt is not None}:
+            args['bytes'] += stage_file(fmt, build_dir / fmt.name,
+                                        pool=pool)
+    sheet.stage(build_dir, pool)
+    jobs = []
+    for mode, text, output_to, fmt in variants:
+        # Variants built side by side need distinct job names
+        name = (sheet.file_name if len(variants) == 1
+                else f'{sheet.file_name}.{mode}')
+        target = build_dir / (name + '.tex')
+        logger.debug(f'Writing {target!s}')
+        target.write_text(text)
+        options = (engine_options if fmt is None
+                   else dict(engine_options, fmt=fmt.stem))
+        jobs.append((sheet, mode, target, output_to, options))
+    return jobs
+
+def _build(sheet, variants, build_dir, includes, engine_options):
+    jobs = stage_build(sheet, variants, build_dir, includes, engine_options)
+    if len(jobs) == 1:
+        return [_compile_variant(*jobs[0])]
+    from contextvars import copy_context
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        futures = [pool.submit(copy_context().run, _compile_variant, *job)
+                   for job in jobs]
+        return [future.result() for future in futures]
+
+def build_status(results):
+    """Overall status of the BuildResults of a sheet."""
+    statuses = {result.status for result in results}
+    return ('built' if statuses == {'built'}
+            else 'timeout' if 'timeout' in statuses
+            else 'failed')
+
+def discard_failed_build(build_dir, results):
+    """Remove build_dir after a failed build, so that a stale or corrupt
+    aux file cannot break the next build when the directory is reused."""
+    if build_status(results) != 'built':
+        logger.debug(f'Removing {build_dir} after a failed build')
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+def _run_build(sheet, label, variants, build_dir, includes, engine_options,
+               trace=False):
+    """Build the variants of a single sheet in its own build directory.
+
+    variants is a list of (mode, text, output_to, fmt) tuples. They share
+    the staged attachments and includes and, if there are several, are
+    compiled concurrently. This runs in a worker process when compiling
+    in parallel, so it only takes picklable arguments and never raises for
+    a failed build. Returns the BuildResults and, if trace is set, the
+    trace events of the build so they can be merged into the parent's
+    trace.
+    """
+    with tracing(trace) as tracer:
+        with span('build', sheet=sheet.file_name, mode=label) as args:
+            results = _build(sheet, variants, build_dir, includes,
+                             engine_options)
+            discard_failed_build(build_dir, results)
+            args.update(status=build_status(results),
+                        passes=sum(result.passes for result in results))
+    return results, (tracer.events if tracer is not None else None)
+
 class ProblemStore:
 
     def __init__(self):
         self.path = Path.cwd()
         self.conf_path = self.path / '.prob'
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._search = None
+        self._env = None
 
-        globs = GLOBALS.get()
-        config = globs['config']
+        config = get_globals()['config']
         config.read([MAIN_CONFIG, self.conf_path / 'config'])
-        GLOBALS.set(globs)
 
         # Store variables
         for k, v in config['problemstore'].items():
@@ -37,6 +145,8 @@ class ProblemStore:
         # Path variables
         for k, v in config['paths'].items():
             setattr(self, k, self.path / v)
+
+        TEXT_CACHE.resize(int(float(self.text_cache_size) * 2**20))
         
     def must_exist(self):
         if not self.path.exists() or not self.conf_path.exists():
@@ -96,6 +206,38 @@ class ProblemStore:
     def get_mixed_dir(self):
         return self.get_sheets_dir() / 'mixed'
 
+    def get_cache_dir(self):
+        path = self.conf_path / self.cache
+        _ensure_exists(path)
+        return path
+
+    def get_watch_dir(self):
+        path = self.get_cache_dir() / 'watch'
+        _ensure_exists(path)
+        return path
+
+    def get_build_manifest(self):
+        from .manifest import BuildManifest
+        return BuildManifest(self.get_cache_dir() / 'build.json',
+                             hash_problem=self.index.content_hash)
+
+    def get_format_cache(self, template, includes):
+        from .preamble import FormatCache
+        path = self.get_cache_dir() / 'formats'
+        _ensure_exists(path)
+        return FormatCache(path, template, includes, engine=self.engine,
+                           limits=self.get_limits())
+
+    def get_engine_options(self):
+        return {'engine': self.engine, 'max_runs': int(self.max_runs)}
+
+    def get_limits(self):
+        def number(value, scale=1):
+            return int(float(value) * scale) if value else None
+        return Limits(timeout=float(self.timeout) if self.timeout else None,
+                      cpu=number(self.cpu_limit),
+                      memory=number(self.memory_limit, 2**20))
+
     def get_dir_for_mode(self, mode):
         if mode == 'questions':
             path = self.sheets_path
@@ -110,39 +252,91 @@ class ProblemStore:
         _ensure_exists(path)
         return path
 
+    def get_output_dirs(self, mode):
+        return {rnd: self.get_dir_for_mode(rnd)
+                for rnd in self.get_rounds(mode)}
+
+    def get_template_env(self):
+        if self._env is None:
+            from jinja2 import (Environment, FileSystemLoader,
+                                FileSystemBytecodeCache)
+            bytecode_dir = self.get_cache_dir() / 'jinja'
+            _ensure_exists(bytecode_dir)
+            self._env = Environment(
+                loader=FileSystemLoader(str(self.conf_path)),
+                bytecode_cache=FileSystemBytecodeCache(str(bytecode_dir)),
+                auto_reload=True)
+        return self._env
+
     def get_template(self, template):
-        from jinja2 import Environment, FileSystemLoader
-        env = Environment(loader=FileSystemLoader(str(self.conf_path)))
-        return env.get_template(template)
+        return self.get_template_env().get_template(template)
+
+    def get_sheet_cache(self):
+        from .parser import read_sheet_cache
+        return read_sheet_cache(self.path,
+                                self.sheet_file(relative=self.path),
+                                self.get_cache_dir() / 'sheets.json')
 
     def get_sheets(self, pats):
-        from .parser import SheetParser
         logger.debug(f'Reading sheet file, with patterns {pats}')
-        with SheetParser(self.path,
-                         self.sheet_file(relative=self.path)) as parser:
-            sheets = [sheet for sheet in parser.parse()
-                      if any(fnmatch(sheet.file_name, pat)
-                             for pat in pats)]
-        return sheets
+        specs = self.get_sheet_cache()['sheets']
+        return [Sheet.from_spec(spec, self.problems_path) for spec in specs
+                if any(fnmatch(spec['file_name'], pat) for pat in pats)]
+
+    def get_used_by(self, id_):
+        return self.get_sheet_cache()['used_by'].get(id_, [])
+
+    def get_sheets_using(self, ids):
+        used_by = self.get_sheet_cache()['used_by']
+        return {name for id_ in ids for name in used_by.get(id_, [])}
+
+    @property
+    def index(self):
+        with self._index_lock:
+            if self._index is None:
+                from .index import ProblemIndex
+                self._index = ProblemIndex(self.conf_path / 'index.db',
+                                           self.problems_path)
+        return self._index
+
+    def reindex(self):
+        number = self.index.rebuild()
+        self.search_index.rebuild()
+        return number
+
+    @property
+    def search_index(self):
+        if self._search is None:
+            from .search import SearchIndex
+            self._search = SearchIndex(self.index)
+        return self._search
+
+    def search(self, query, macros=False, math=False, limit=20,
+               update=True):
+        if update:
+            self.search_index.update()
+        return self.search_index.search(query, macros=macros, math=math,
+                                        limit=limit)
 
     def list_problems(self):
-        return [d.name for d in self.problems_path.iterdir() if d.is_dir()]
+        return self.index.list_problems()
        
     def get_problem(self, id_, must_exist=True):
-        if not self.problems_path.exists():
-            self.problems_path.exists.mkdir()
         problem_path = self.problems_path / id_
-        if must_exist and not problem_path.exists():
+        if must_exist and not self.index.has_problem(id_):
             raise RuntimeError(f'Problem {id_} does not exist')
         return Problem(id_, problem_path)
 
     def rm_problem(self, id_):
-        if self.check_problem(id_):
+        if self.index.has_problem(id_):
             shutil.rmtree(self.problems_path / id_)
+            self.index.remove(id_)
 
     def new_problem(self, id_):
+        _ensure_exists(self.problems_path)
         problem = self.get_problem(id_, must_exist=False)
         problem.create()
+        self.index.add(id_)
         return problem
         
     def get_problem_text(self, id_):
@@ -170,79 +364,274 @@ class ProblemStore:
     def get_includes(self):
         return (self.conf_path / self.include).glob('*')
 
-    def write_and_compile(self, mode, sheets, output_to, template):
+    def build_context(self, build_root=None):
+        # Build beside the store so attachments can be hardlinked. A
+        # build_root keeps the build directories warm between calls.
+        if build_root is None:
+            return TemporaryDirectory(dir=self.get_cache_dir())
+        return nullcontext(build_root)
+
+    def plan_builds(self, mode, sheets, output_to, template, dst,
+                    manifest=None, force=False, build_root=None):
+        """Render sheets for each round of mode and decide what to build.
+
+        Yields a skipped BuildResult for each variant that is up to date
+        in manifest, and a BuildTask for each sheet with variants to build
+        in a build directory under dst.
+        """
+        rounds = self.get_rounds(mode)
+        if not isinstance(output_to, dict):
+            output_to = {rnd: output_to for rnd in rounds}
+        use_template = self.get_template(template)
+        includes = list(self.get_includes())
+        engine_options = self.get_engine_options()
+        # Limits do not change the output, so they stay out of the hash
+        build_options = dict(engine_options, limits=self.get_limits())
+        use_formats = _as_bool(self.preamble_format)
+        # Created on the first sheet that needs building, so that an up to
+        # date compile never dumps a format
+        formats = None
+        for sheet in sheets:
+            variants = []
+            digests = dict()
+            for rnd in rounds:
+                with span('render', sheet=sheet.file_name, mode=rnd):
+                    text = sheet.render_mode(rnd, use_template)
+                if manifest is not None:
+                    key = manifest.key(rnd, sheet)
+                    with span('hash', sheet=sheet.file_name, mode=rnd):
+                        digests[key] = manifest.sheet_hash(
+                            sheet, text, includes, engine_options)
+                    final = output_to[rnd] / (sheet.file_name + '.pdf')
+                    if not force and manifest.is_current(
+                            key, digests[key][0], final):
+                        logger.debug(f'Sheet {sheet.file_name} ({rnd}) '
+                                     'is up to date')
+                        yield BuildResult(sheet, rnd, final, 'skipped', 0)
+                        continue
+                fmt = None
+                if use_formats:
+                    if formats is None:
+                        formats = self.get_format_cache(use_template,
+                                                        includes)
+                    try:
+                        with span('format', sheet=sheet.file_name):
+                            text, fmt = formats.prepare(text)
+                    except BuildTimeout as e:
+                        logger.warning(f'{sheet.file_name} ({rnd}): '
+                                       f'preamble format {e}')
+                        yield BuildResult(sheet, rnd, None, 'timeout', 0)
+                        continue
+                variants.append((rnd, text, output_to[rnd], fmt))
+            if not variants:
+                continue
+            if build_root is None:
+                build_dir = Path(mkdtemp(prefix=f'{sheet.file_name}-',
+                                         dir=dst))
+            else:
+                build_dir = dst / f'{mode}-{sheet.file_name}'
+                build_dir.mkdir(parents=True, exist_ok=True)
+            label = mode if len(variants) > 1 else variants[0][0]
+            yield BuildTask(sheet, label, variants, build_dir, includes,
+                            build_options, digests)
+
+    def write_and_compile(self, mode, sheets, output_to, template, jobs=1,
+                          manifest=None, force=False, build_root=None):
+        """Build sheets in mode and yield a BuildResult per sheet and round.
+
+        output_to is the output directory, or a dictionary mapping each
+        round of mode to one. In "both" mode the two variants of a sheet
+        are built from a single build directory.
+        """
         if not sheets:
             raise ValueError('No sheets to build, aborting')
         
-        use_template = self.get_template(template)
-        with TemporaryDirectory() as tmp:
+        trace = TRACER.get() is not None
+        with self.build_context(build_root) as tmp:
             dst = Path(tmp)
             
-            includes = list(self.get_includes())
-            for incl in includes:
-                shutil.copy(incl, dst / incl.name)
-        
-            for sheet in sheets:
-                try:
-                    yield sheet.write_and_compile(mode,
-                                                  dst,
-                                                  output_to,
-                                                  use_template)
-                except RuntimeError as e:
-                    logger.warning(e)
-                    yield None
+            tasks = []
+            digests = dict()
+            for item in self.plan_builds(mode, sheets, output_to, template,
+                                         dst, manifest=manifest, force=force,
+                                         build_root=build_root):
+                if isinstance(item, BuildResult):
+                    yield item
+                else:
+                    digests.update(item.digests)
+                    tasks.append((*item[:-1], trace))
+
+            if jobs == 1:
+                outcomes = (_run_build(*task) for task in tasks)
+            else:
+                from concurrent.futures import (ProcessPoolExecutor,
+                                                as_completed)
+                pool = ProcessPoolExecutor(max_workers=jobs)
+                futures = [pool.submit(_run_build, *task) for task in tasks]
+                outcomes = (future.result()
+                            for future in as_completed(futures))
+            try:
+                for results, events in outcomes:
+                    if trace:
+                        TRACER.get().extend(events)
+                    for result in results:
+                        if manifest is not None and result.status == 'built':
+                            key = manifest.key(result.mode, result.sheet)
+                            manifest.record(key, *digests[key])
+                        yield result
+            finally:
+                if jobs != 1:
+                    pool.shutdown(cancel_futures=True)
+                if manifest is not None:
+                    manifest.save()
                 
-        logger.debug(f'Deleting temporary directory {dst}')
-                
-    def compile(self, mode, pats):
-        sheets = self.get_sheets(pats)
-        number = len(sheets)
+        logger.debug(f'Finished building in {dst}')
 
+    @staticmethod
+    def get_rounds(mode):
         if mode == 'both':
-            rounds = ['questions', 'solutions']
-        else:
-            rounds = [mode]
+            return ['questions', 'solutions']
+        return [mode]
+                
+    def select_sheets(self, sheets, mode, changed=False, problems=None):
+        """Restrict sheets to those using problems, if given, and to those
+        whose problems or includes changed since the last build, if
+        changed is set."""
+        if problems:
+            using = self.get_sheets_using(problems)
+            sheets = [sheet for sheet in sheets if sheet.file_name in using]
+        if changed:
+            manifest = self.get_build_manifest()
+            includes = list(self.get_includes())
+            sheets = [sheet for sheet in sheets
+                      if any(manifest.is_changed(manifest.key(rnd, sheet),
+                                                 sheet, includes)
+                             for rnd in self.get_rounds(mode))]
+        return sheets
+                
+    def compile(self, mode, pats, jobs=1, force=False, changed=False,
+                problems=None):
+        with span('parse'):
+            sheets = self.select_sheets(self.get_sheets(pats), mode,
+                                        changed=changed, problems=problems)
+        number = len(sheets)
+        rounds = self.get_rounds(mode)
             
         yield number*len(rounds)
-        for rnd in rounds:
-            yield from self.write_and_compile(rnd, sheets,
-                                              self.get_dir_for_mode(rnd),
-                                              self.template)
+        if not sheets:
+            return
+        yield from self.write_and_compile(mode, sheets,
+                                          self.get_output_dirs(mode),
+                                          self.template,
+                                          jobs=jobs,
+                                          manifest=self.get_build_manifest(),
+                                          force=force)
+
+    def compile_async(self, mode, pats, concurrency=1, force=False,
+                      changed=False, problems=None):
+        """Async iterator counterpart of compile, running at most
+        concurrency engines at once, see aio.compile_sheets."""
+        from .aio import compile_sheets
+        return compile_sheets(self, mode, pats, concurrency=concurrency,
+                              force=force, changed=changed, problems=problems)
+
+    def write_and_compile_async(self, mode, sheets, output_to, template,
+                                concurrency=1, manifest=None, force=False,
+                                build_root=None):
+        from .aio import write_and_compile
+        return write_and_compile(self, mode, sheets, output_to, template,
+                                 concurrency=concurrency, manifest=manifest,
+                                 force=force, build_root=build_root)
+
+    def get_preview_cache(self):
+        from .previews import PreviewCache
+        path = self.get_cache_dir() / 'previews'
+        _ensure_exists(path)
+        return PreviewCache(path, int(float(self.preview_cache_size) * 2**20))
+
+    def preview_key(self, id_):
+        """Hash of everything the preview of a problem is built from."""
+        inputs = [('problem', self.index.content_hash(id_)),
+                  ('template',
+                   hash_file(self.conf_path / self.preview_template))]
+        inputs.extend((f'include/{incl.name}', hash_file(incl))
+                      for incl in self.get_includes() if incl.is_file())
+        inputs.extend((f'engine/{k}', str(v))
+                      for k, v in self.get_engine_options().items())
+        return digest_files(inputs)
+
+    def build_previews(self, ids, jobs=1, cache=None):
+        """Build the previews of ids and yield (id, pdf) pairs, pdf being
+        None if the build failed.
+
+        With a cache the previews are stored in it. Otherwise the pdf only
+        exists until the generator is resumed.
+        """
+        keys = {id_: self.preview_key(id_) for id_ in ids} if cache else {}
+        sheets = [self.get_problem(id_).get_preview_sheet(id_) for id_ in ids]
+        for result in self.write_and_compile('mixed', sheets, None,
+                                             self.preview_template,
+                                             jobs=jobs):
+            id_ = result.sheet.file_name
+            pdf = result.pdf
+            if pdf and cache:
+                pdf = cache.put(keys[id_], pdf)
+            yield id_, pdf
 
     @contextmanager    
     def preview(self, id_):
-        sheet = self.get_problem(id_).get_preview_sheet()
-        compiler = self.write_and_compile('mixed', [sheet], None,
-                                          self.preview_template)
-        # advance to yield the number of sheets == 1
-        pdf = next(compiler)
+        cache = self.get_preview_cache()
+        if cache.max_bytes <= 0:
+            cache = None
+        pdf = cache.get(self.preview_key(id_)) if cache else None
+        if pdf is None:
+            compiler = self.build_previews([id_], cache=cache)
+            # advance to yield the result for the single preview sheet
+            _, pdf = next(compiler)
         if not pdf:
             raise RuntimeError(f'Problem {id_} preview build failed.')
         yield pdf
-        logger.debug(f'Removing preview file {pdf.name}')
-        
+
+    def prefetch_previews(self, pattern, jobs=1):
+        """Build the previews of the problems matching pattern that are
+        not cached yet, and yield (id, pdf) pairs."""
+        cache = self.get_preview_cache()
+        ids = [id_ for id_ in self.list_problems() if fnmatch(id_, pattern)
+               and not cache.pdf_path(self.preview_key(id_)).exists()]
+        if ids:
+            yield from self.build_previews(ids, jobs=jobs, cache=cache)
 
     ##### Merging stores
 
     def merge_other(self, other, overwrite=False):
-        if isinstance(other, (str, Path)):
-            other = ProblemStore.from_path(other)
-        else:
-            raise ValueError(f'Cannot merge, {other} is not a problem store')
-        self_probs = set(self.list_problems())
-        other_probs = set(other.list_problems())
-        in_both = self_probs.intersect(other_probs)
-        in_other = other_probs.difference(self_probs)
+        """Merge the problems of another store or of an archive.
 
-        for prb_id in in_other:
-            other.get_problem(prb_id).clone(self.get_problem_dir())
-
-        if overwrite:
-            for prb_id in in_both:
-                other.get_problem(prb_id).clone(self.get_problem_dir())
+        Returns a MergeResult; problems that differ on both sides are
+        reported as conflicts and left untouched unless overwrite is set.
+        """
+        from .merge import open_source, merge_problems
+        return merge_problems(self, open_source(other), overwrite=overwrite)
 
         
 
     
             
     
+
+    ##### Importing and exporting problems
+
+    def import_problems(self, f, jobs=1, batch_size=100):
+        """Import problems from a stream of JSON records, see
+        bulk.import_problems. Returns an ImportResult."""
+        from .bulk import import_problems
+        return import_problems(self, f, jobs=jobs, batch_size=batch_size)
+
+    def export_problems(self, f, pats=None, fmt='jsonl', jobs=1,
+                        batch_size=100):
+        """Export the problems matching any of pats, or all of them, to
+        a stream of JSON records. Returns the number exported."""
+        from .bulk import export_problems
+        ids = [id_ for id_ in sorted(self.list_problems())
+               if not pats or any(fnmatch(id_, pat) for pat in pats)]
+        return export_problems(self, f, ids, fmt=fmt, jobs=jobs,
+                               batch_size=batch_size)
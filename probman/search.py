@@ -0,0 +1,222 @@
+import logging
+import os
+import re
+import sqlite3
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+SearchHit = namedtuple('SearchHit', ('problem_id', 'rank', 'snippet'))
+
+# Bump when the way text is split into fields changes, so that existing
+# search indexes are rebuilt.
+TOKENIZER_VERSION = '1'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS search_state (
+    rowid INTEGER PRIMARY KEY,
+    problem_id TEXT UNIQUE,
+    question_stat TEXT,
+    solution_stat TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5 (
+    question, solution, macros, math,
+    tokenize = "unicode61 remove_diacritics 2"
+);
+'''
+
+# bm25 weights of the columns, matches in the text rank above matches in
+# macro names and formulas
+WEIGHTS = (2.0, 1.0, 0.5, 0.5)
+
+COMMENTRE = re.compile(r'(?<!\\)%.*')
+MATHRE = re.compile(r'(?<!\\)\$\$(.+?)(?<!\\)\$\$|(?<!\\)\$(.+?)(?<!\\)\$'
+                    r'|\\\((.+?)\\\)|\\\[(.+?)\\\]'
+                    r'|\\begin\{(?P<env>equation|align|gather|multline|'
+                    r'eqnarray|displaymath|math)(?P<star>\*?)\}(.+?)'
+                    r'\\end\{(?P=env)(?P=star)\}', re.S)
+# Macros whose arguments are labels or file names rather than text
+REFRE = re.compile(r'\\(label|ref|eqref|pageref|cite|includegraphics|input|'
+                   r'include|usepackage|documentclass|begin|end)\*?'
+                   r'(\[[^\]]*\])?\{([^}]*)\}')
+MACRORE = re.compile(r'\\([A-Za-z@]+)\*?|\\.')
+GROUPING = str.maketrans('{}&~', '    ')
+
+
+def tex_fields(text):
+    """Split TeX source into (words, macro names, math).
+
+    Comments are dropped, math is moved to its own field and macro names
+    are removed from the words, keeping the text of their arguments.
+    Environment names are listed with the macros.
+    """
+    text = COMMENTRE.sub('', text)
+    math = []
+    macros = []
+
+    def take_math(match):
+        body = next(group for i, group in enumerate(match.groups())
+                    if group is not None and i not in (4, 5))
+        math.append(body)
+        if match.group('env'):
+            macros.extend(('begin', match.group('env')))
+        return ' '
+
+    def take_ref(match):
+        macros.append(match.group(1))
+        if match.group(1) in ('begin', 'end'):
+            macros.append(match.group(3))
+        return ' '
+
+    text = MATHRE.sub(take_math, text)
+    text = REFRE.sub(take_ref, text)
+    macros.extend(name for name in MACRORE.findall(text) if name)
+    for formula in math:
+        macros.extend(name for name in MACRORE.findall(formula) if name)
+    words = MACRORE.sub(' ', text).translate(GROUPING)
+    math = ' '.join(MACRORE.sub(lambda m: f' {m.group(1) or ""} ',
+                                        formula)
+                    for formula in math)
+    return words, ' '.join(macros), math
+
+
+class SearchIndex:
+    """Full-text index of problem questions and solutions.
+
+    The index lives in the problem index database and is brought up to
+    date before each search, reindexing only the problems whose files
+    changed mtime or size.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.db = index.db
+        try:
+            with self.index.lock:
+                self.db.executescript(SCHEMA)
+        except sqlite3.OperationalError as e:
+            raise RuntimeError('Searching needs SQLite with FTS5 '
+                               f'support ({e})')
+        with self.index.lock:
+            version = self.index._get_meta('search_version')
+        if version != TOKENIZER_VERSION:
+            self.clear()
+
+    def clear(self):
+        with self.index.lock, self.db:
+            self.db.execute('DELETE FROM search')
+            self.db.execute('DELETE FROM search_state')
+            self.index._set_meta('search_version', TOKENIZER_VERSION)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, errors='replace') as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return f'{st.st_mtime_ns}:{st.st_size}'
+
+    def update(self, ids=None):
+        """Reindex new and changed problems and drop removed ones.
+
+        If ids is given only those problems are checked for changes. The
+        check is one stat per file, done on plain strings since it runs
+        over every problem before each search. Returns the number of
+        problems reindexed.
+        """
+        with self.index.lock:
+            return self._update(ids)
+
+    def _update(self, ids):
+        known = set(self.index.list_problems())
+        state = {id_: (rowid, q_stat, s_stat) for rowid, id_, q_stat, s_stat
+                 in self.db.execute('SELECT rowid, problem_id, '
+                                    'question_stat, solution_stat '
+                                    'FROM search_state')}
+        if ids is None:
+            removed = set(state) - known
+            ids = known
+        else:
+            removed = {id_ for id_ in ids if id_ in state
+                       and id_ not in known}
+            ids = known.intersection(ids)
+        root = str(self.index.problems_path)
+        updated = 0
+        with self.db:
+            for id_ in removed:
+                rowid = state[id_][0]
+                self.db.execute('DELETE FROM search WHERE rowid = ?',
+                                (rowid,))
+                self.db.execute('DELETE FROM search_state WHERE rowid = ?',
+                                (rowid,))
+            for id_ in sorted(ids):
+                question_path = os.path.join(root, id_, 'problem.tex')
+                solution_path = os.path.join(root, id_, 'solution.tex')
+                stats = (self._stat(question_path), self._stat(solution_path))
+                rowid, *old_stats = state.get(id_, (None, None, None))
+                if rowid is not None and tuple(old_stats) == stats:
+                    continue
+                q_words, q_macros, q_math = tex_fields(
+                    self._read(question_path))
+                s_words, s_macros, s_math = tex_fields(
+                    self._read(solution_path))
+                if rowid is None:
+                    rowid = self.db.execute(
+                        'INSERT INTO search_state (problem_id, question_stat,'
+                        ' solution_stat) VALUES (?, ?, ?)',
+                        (id_, *stats)).lastrowid
+                else:
+                    self.db.execute('DELETE FROM search WHERE rowid = ?',
+                                    (rowid,))
+                    self.db.execute('UPDATE search_state SET '
+                                    'question_stat = ?, solution_stat = ? '
+                                    'WHERE rowid = ?', (*stats, rowid))
+                self.db.execute('INSERT INTO search (rowid, question, '
+                                'solution, macros, math) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (rowid, q_words, s_words,
+                                 f'{q_macros} {s_macros}',
+                                 f'{q_math} {s_math}'))
+                updated += 1
+        if updated:
+            logger.debug(f'Reindexed {updated} problems for search')
+        return updated
+
+    def rebuild(self):
+        self.clear()
+        return self.update()
+
+    def search(self, query, macros=False, math=False, limit=20):
+        """Return the SearchHits for an FTS5 query, best match first.
+
+        The query supports AND, OR, NOT, "phrases", prefix* searches and
+        NEAR(). Only the question and solution text are searched unless
+        macros or math are set.
+        """
+        columns = ['question', 'solution']
+        if macros:
+            columns.append('macros')
+        if math:
+            columns.append('math')
+        weights = ', '.join(str(w) for w in WEIGHTS)
+        try:
+            with self.index.lock:
+                rows = self.db.execute(
+                    'SELECT s.problem_id, bm25(search, ' + weights + ') '
+                    "AS rank, snippet(search, -1, '[', ']', '...', 10) "
+                    'FROM search JOIN search_state AS s '
+                    'ON s.rowid = search.rowid '
+                    'WHERE search MATCH ? ORDER BY rank LIMIT ?',
+                    (f'{{{" ".join(columns)}}} : ({query})', limit)
+                ).fetchall()
+        except sqlite3.OperationalError as e:
+            raise RuntimeError(f'Invalid search query {query!r}: {e}')
+        return [SearchHit(*row) for row in rows]
@@ -1,11 +1,15 @@
 import logging
 import shutil
+import sys
+import threading
 from pathlib import Path
 from functools import partialmethod
-from collections import namedtuple
+from collections import namedtuple, defaultdict, OrderedDict
 from subprocess import run, PIPE
 
-from .utils import tex_compile
+from .trace import span
+from .utils import (tex_compile, hash_file, digest_files, stage_file,
+                    publish_file, write_text)
 
 
 logger = logging.getLogger(__name__)
@@ -13,6 +17,81 @@ logger = logging.getLogger(__name__)
 ##Requirement = namedtuple('Requirement', ('type', 'data'))
 
 
+class TextCache:
+    """Least recently used cache of file contents, bounded in bytes.
+
+    Entries are validated against the mtime and size of the file on every
+    lookup, so a file changed behind the cache's back is read again. The
+    size of an entry is that of its string object, so the bound is
+    approximate.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _stat(path):
+        st = path.stat()
+        return st.st_mtime_ns, st.st_size
+
+    def _store(self, path, stat, text):
+        size = sys.getsizeof(text)
+        with self.lock:
+            self._discard(path)
+            if size > self.max_bytes:
+                return
+            self.entries[path] = (stat, text, size)
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            _, (_, _, old_size) = self.entries.popitem(last=False)
+            self.size -= old_size
+
+    def _discard(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def read(self, path):
+        stat = self._stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == stat:
+                self.entries.move_to_end(path)
+                return entry[1]
+        text = path.read_text()
+        self._store(path, stat, text)
+        return text
+
+    def write(self, path, text):
+        try:
+            write_text(path, text)
+        except BaseException:
+            with self.lock:
+                self._discard(path)
+            raise
+        self._store(path, self._stat(path), text)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+
+# Resized to the text_cache_size setting when a store is opened
+TEXT_CACHE = TextCache(max_bytes=64 << 20)
+
+
 class Problem:
 
     def __init__(self, problem_id, path):
@@ -21,6 +100,8 @@ class Problem:
         self.question_path = self.path / 'problem.tex'
         self.solution_path = self.path / 'solution.tex'
         self.attach_path = self.path / 'attach'
+        self._attachments = None
+        self._attachment_keys = None
     
     def exists(self):
         return self.path.exists()
@@ -33,21 +114,54 @@ class Problem:
         self.solution_path.touch()
         
     def get_question(self):
-        return self.question_path.read_text()
+        return TEXT_CACHE.read(self.question_path)
 
     def get_solution(self):
-        return self.solution_path.read_text()
-
-    def copy_attachments_to(self, dst):
-        for attach in self.attach_path.glob('*'):
-            logger.debug(f'Copying {attach.name} to {dst}')
-            shutil.copy(attach, dst / attach.name)
+        return TEXT_CACHE.read(self.solution_path)
+
+    def _attachment_index(self):
+        """Map attachment names and stems to the attachment files.
+
+        Each file is indexed under its full name and under every prefix
+        ending before a dot, so "plot", "plot.eps" and "plot.eps.gz" all
+        find "plot.eps.gz". The index is built on first use and dropped
+        whenever attachments are added or removed.
+        """
+        if self._attachment_keys is None:
+            files = []
+            keys = defaultdict(list)
+            if self.attach_path.exists():
+                for path in sorted(self.attach_path.iterdir()):
+                    if not path.is_file():
+                        continue
+                    files.append(path)
+                    parts = path.name.split('.')
+                    for i in range(1, len(parts) + 1):
+                        keys['.'.join(parts[:i])].append(path)
+            self._attachments = files
+            self._attachment_keys = dict(keys)
+        return self._attachment_keys
+
+    def _invalidate_attachments(self):
+        self._attachments = None
+        self._attachment_keys = None
+
+    def find_attachments(self, name):
+        return self._attachment_index().get(name, [])
+
+    def copy_attachments_to(self, dst, pool=None):
+        self._attachment_index()
+        copied = 0
+        for attach in self._attachments:
+            logger.debug(f'Staging {attach.name} in {dst}')
+            copied += stage_file(attach, dst / attach.name, pool=pool)
+        return copied
 
     def update_question_text(self, text):
-        self.question_path.write_text(text)
+        TEXT_CACHE.write(self.question_path, text)
 
     def update_solution_text(self, text):
-        self.solution_path.write_text(text)
+        TEXT_CACHE.write(self.solution_path, text)
         
     def add_attachment(self, attachment, overwrite=False):
         self.attach_path.mkdir(exist_ok=True)
@@ -57,24 +171,38 @@ class Problem:
                                f'{self.problem_id}, '
                                'file already exists')
         shutil.copy(attachment, new_path)
+        self._invalidate_attachments()
     
     def add_attachments(self, attachments, overwrite=False):
         for attach in attachments:
             self.add_attachment(self, attach, overwrite=overwrite)
 
     def rm_attachment(self, name):
-        for attach in self.attach_path.glob(name + '*'):
+        for attach in self.find_attachments(name):
             logger.info(f'Removing {attach!s}')
             attach.unlink()
+        self._invalidate_attachments()
     
     def has_attachment(self, name):
-        return any(self.attach_path.glob(name + '*'))
+        return name in self._attachment_index()
 
     def list_attachments(self):
-        return list(self.attach_path.iterdir())
-
-    def get_preview_sheet(self):
-        return Sheet('preview', None, {}, [(self, None)])
+        self._attachment_index()
+        return list(self._attachments)
+
+    def list_files(self):
+        files = [path for path in (self.question_path, self.solution_path)
+                 if path.exists()]
+        files.extend(self.list_attachments())
+        return files
+
+    def content_hash(self):
+        files = ((path.relative_to(self.path).as_posix(), hash_file(path))
+                 for path in self.list_files())
+        return digest_files(files)
+
+    def get_preview_sheet(self, name='preview'):
+        return Sheet(name, None, {}, [(self, None)])
     
     def clone(self, path):
         shutil.copytree(self.path, path)
@@ -88,19 +216,68 @@ class Problem:
 
 
 class Sheet:
+    """A sheet built from a list of problems.
+
+    If problem_dir is given, problems is a list of (problem id, mark)
+    pairs and the Problem objects are only created when first needed.
+    Otherwise problems is a list of (Problem, mark) pairs.
+    """
 
-    def __init__(self, file_name, sheet_type, metadata, problems):
+    def __init__(self, file_name, sheet_type, metadata, problems,
+                 problem_dir=None):
         self.file_name = file_name
         self.sheet_type = sheet_type
         self.metadata = metadata
-        self.problems = problems
+        self.problem_dir = problem_dir
+        if problem_dir is None:
+            self.problems = problems
+        else:
+            self.problem_refs = problems
+            self._problems = None
+
+    @property
+    def problems(self):
+        if self._problems is None:
+            self._problems = [(Problem(id_, self.problem_dir / id_), mark)
+                              for id_, mark in self.problem_refs]
+        return self._problems
+
+    @problems.setter
+    def problems(self, problems):
+        self._problems = problems
+        self.problem_refs = [(prob.problem_id, mark)
+                             for prob, mark in problems]
+
+    def to_spec(self):
+        return {'file_name': self.file_name,
+                'sheet_type': self.sheet_type,
+                'metadata': self.metadata,
+                'problems': self.problem_refs}
+
+    @classmethod
+    def from_spec(cls, spec, problem_dir):
+        return cls(spec['file_name'], spec['sheet_type'], spec['metadata'],
+                   [tuple(ref) for ref in spec['problems']], problem_dir)
         
-    def _write_file(self, dst, template, include_problems, include_solutions):
-        logger.debug(f'Writing {dst!s}')
-        text = template.render(problems=self.problems,
+    def render(self, template, include_problems, include_solutions):
+        return template.render(problems=self.problems,
                                include_problems=include_problems,
                                include_solutions=include_solutions,
                                **self.metadata)
+
+    def render_mode(self, mode, template):
+        if mode == 'questions':
+            return self.render(template, True, False)
+        elif mode == 'solutions':
+            return self.render(template, False, True)
+        elif mode == 'mixed':
+            return self.render(template, True, True)
+        else:
+            raise NotImplementedError()
+
+    def _write_file(self, dst, template, include_problems, include_solutions):
+        logger.debug(f'Writing {dst!s}')
+        text = self.render(template, include_problems, include_solutions)
         dst.write_text(text)    
  
     def create_question_file(self, dst, template):
@@ -119,33 +296,46 @@ class Sheet:
         return tex_compile(target, **kwargs)
 
 
-    def write_and_compile(self, mode, build_dir, out_dir, template):
+    def write_and_compile(self, mode, build_dir, out_dir, template, **kwargs):
         target = build_dir / (self.file_name + '.tex')
-        built = build_dir / (self.file_name + '.pdf')
-        if out_dir is None:
-            out_dir = build_dir
-        final = out_dir / (self.file_name + '.pdf')
-
-        if mode == 'questions':
-            self.create_question_file(target, template)
-        elif mode == 'solutions':
-            self.create_answer_file(target, template)
-        elif mode == 'mixed':
-            self.create_mixed_file(target, template)
-        else:
-            raise NotImplementedError()
-        
-        for prob, _ in self.problems:
-            prob.copy_attachments_to(build_dir)
-
-        if not self.compile_only(target):
-            raise RuntimeError(f'Build failed for {target}')
-
-        if not build_dir == out_dir:
-            logger.debug(f'Moving {built} to {out_dir}')
-            shutil.copy(built, final)
+        logger.debug(f'Writing {target!s}')
+        target.write_text(self.render_mode(mode, template))
+        self.stage(build_dir)
+        final, _ = self.build(target, out_dir, **kwargs)
         return final
 
+    def stage(self, build_dir, pool=None):
+        """Stage the attachments of every problem in build_dir and return
+        the number of bytes copied, see stage_file for pool."""
+        with span('stage', what='attachments') as args:
+            args['bytes'] = sum(prob.copy_attachments_to(build_dir, pool)
+                                for prob, _ in self.problems)
+        return args['bytes']
+
+    def output_paths(self, target, out_dir):
+        """Return the pdf the engine writes for target and the path it is
+        published to in out_dir, removing any stale pdf."""
+        built = target.with_suffix('.pdf')
+        if out_dir is None:
+            out_dir = target.parent
+        # The previous output may be hardlinked to a published copy, so
+        # unlink it rather than let the engine write through it.
+        if built.exists():
+            built.unlink()
+        return built, out_dir / (self.file_name + '.pdf')
+
+    def publish(self, built, final):
+        if built != final:
+            logger.debug(f'Publishing {built} to {final.parent}')
+            with span('publish') as args:
+                args['bytes'] = publish_file(built, final)
+        return final
 
-
-        
+    def build(self, target, out_dir, **kwargs):
+        """Compile target, whose attachments must already be staged, and
+        publish it to out_dir as <file_name>.pdf."""
+        built, final = self.output_paths(target, out_dir)
+        result = self.compile_only(target, **kwargs)
+        if not result.success:
+            raise RuntimeError(f'Build failed for {target}')
+        return self.publish(built, final), result.passes
@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+TRACER = ContextVar('TRACER', default=None)
+
+
+def _now_us():
+    return time.time_ns() // 1000
+
+
+class Tracer:
+    """Collects timed spans as trace events.
+
+    Events use wall-clock microseconds so that events recorded in worker
+    processes can be merged with those of the parent.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    @contextmanager
+    def span(self, name, cat='probman', **args):
+        start = _now_us()
+        try:
+            yield args
+        finally:
+            self.events.append({'name': name,
+                                'cat': cat,
+                                'ts': start,
+                                'dur': _now_us() - start,
+                                'pid': os.getpid(),
+                                'tid': threading.get_ident(),
+                                'args': args})
+
+    def extend(self, events):
+        if events:
+            self.events.extend(events)
+
+    def write(self, path, fmt='jsonl'):
+        logger.debug(f'Writing {len(self.events)} trace events to {path}')
+        with open(path, 'w') as f:
+            if fmt == 'chrome':
+                json.dump({'traceEvents': [dict(event, ph='X')
+                                           for event in self.events],
+                           'displayTimeUnit': 'ms'}, f, default=str)
+            else:
+                for event in self.events:
+                    f.write(json.dumps(event, default=str) + '\n')
+
+    def slowest(self, name='build', number=10):
+        events = [event for event in self.events if event['name'] == name]
+        events.sort(key=lambda event: event['dur'], reverse=True)
+        return events[:number]
+
+    def bytes_within(self, outer):
+        """Total bytes recorded by the spans nested in outer."""
+        end = outer['ts'] + outer['dur']
+        return sum(event['args'].get('bytes', 0) for event in self.events
+                   if event['pid'] == outer['pid']
+                   and event['tid'] == outer['tid']
+                   and outer['ts'] <= event['ts'] <= end
+                   and event is not outer)
+
+
+@contextmanager
+def span(name, **args):
+    """Record a span with the current tracer, if tracing is enabled.
+
+    Yields the span's argument dictionary so the body can add details,
+    such as the number of bytes copied, that are only known at the end.
+    """
+    tracer = TRACER.get()
+    if tracer is None:
+        yield args
+    else:
+        with tracer.span(name, **args) as span_args:
+            yield span_args
+
+
+@contextmanager
+def tracing(enabled=True):
+    """Install a fresh tracer for the body and yield it, or None."""
+    if not enabled:
+        yield None
+        return
+    tracer = Tracer()
+    token = TRACER.set(tracer)
+    try:
+        yield tracer
+    finally:
+        TRACER.reset(token)
@@ -1,36 +1,25 @@
 
 import base64
+import hashlib
+import json
 import logging
 import re
 import os
 import shutil
+import signal
+import sys
+import threading
 from pathlib import Path
+from collections import namedtuple
 from contextlib import contextmanager
-from tempfile import TemporaryDirectory
-from subprocess import run, PIPE
+from subprocess import Popen, PIPE, CompletedProcess, TimeoutExpired
 
-logger = logging.getLogger(__name__)
-
-def compress(tree, outfile, algorithm):
-    return shutil.make_archive(outfile,
-                               algorithm,
-                               root_dir=tree,
-                               base_dir=tree,
-                               logger=logger)
+from .trace import span
 
-@contextmanager
-def decompress(path, algorithm=None):
-    with TemporaryDirectory() as tmp:
-        tmp = Path(tmp)
-        try:
-            shutil.unpack_archive(path, extract_dir=tmp, format=algorithm)
-            yield tmp
-        except ValueError as e:
-            yield None
-            raise e
+logger = logging.getLogger(__name__)
 
 @contextmanager
-def change_cwd(self, path):
+def change_cwd(path):
     current = Path.cwd()
     os.chdir(path)
     try:
@@ -38,38 +27,287 @@ def change_cwd(self, path):
     finally:
         os.chdir(current)
 
-def check_is_archive(path):
-    rv = False
-    ext = ['.zip', '.tar.gz', '.tar.xz', '.bz2']
-    if any(path.endswith(e) for e in ext):
-        rv = True
-    return rv
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def digest_files(files):
+    """Combine (relative name, content hash) pairs into a single digest.
+
+    The pairs are sorted so the digest does not depend on the order in
+    which the files were discovered.
+    """
+    h = hashlib.sha256()
+    for name, file_hash in sorted(files):
+        h.update(f'{name}\0{file_hash}\n'.encode())
+    return h.hexdigest()
+
+# ioctl request number for FICLONE on Linux
+FICLONE = 0x40049409
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+
+def _is_staged(src, dst):
+    try:
+        if os.path.samefile(src, dst):
+            return True
+        st_src, st_dst = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    # A reflink or a copy: size and mtime rule out most changes cheaply,
+    # but an edit can keep both, so the contents decide.
+    return (st_src.st_size == st_dst.st_size
+            and st_src.st_mtime_ns == st_dst.st_mtime_ns
+            and hash_file(src) == hash_file(dst))
+
+def _stage_pooled(src, dst, pool):
+    """Copy src into pool once, named by its content hash, and hardlink
+    the pooled copy to dst. Returns the number of bytes copied."""
+    pooled = os.path.join(pool, hash_file(src))
+    copied = 0
+    if not os.path.exists(pooled):
+        tmp = f'{pooled}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.copy2(src, tmp)
+        os.replace(tmp, pooled)
+        copied = os.path.getsize(pooled)
+    os.link(pooled, dst)
+    return copied
+
+def stage_file(src, dst, allow_symlink=True, pool=None):
+    """Make src available at dst, copying only as a last resort.
+
+    Tries a hardlink, then a reflink, then (if allowed) a symlink before
+    falling back to a copy. If pool is a directory on the same device as
+    dst, the copy is made there and hardlinked, so that a file staged in
+    several build directories sharing the pool is copied only once.
+    Nothing is done if dst already holds the same file. Returns the
+    number of bytes copied.
+    """
+    if _is_staged(src, dst):
+        return 0
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+        return 0
+    except OSError:
+        pass
+    if sys.platform.startswith('linux'):
+        try:
+            _reflink(src, dst)
+            shutil.copystat(src, dst)
+            return 0
+        except OSError:
+            pass
+    if allow_symlink:
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return 0
+        except OSError:
+            pass
+    if pool is not None:
+        try:
+            return _stage_pooled(src, dst, pool)
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return os.path.getsize(dst)
+
+def publish_file(src, dst):
+    """Atomically replace dst with the contents of src.
+
+    The file is staged next to dst without symlinks, since src usually
+    lives in a build directory that is about to be removed.
+    """
+    tmp = dst.with_name(f'.{dst.name}.tmp')
+    copied = stage_file(src, tmp, allow_symlink=False)
+    os.replace(tmp, dst)
+    return copied
+
+def read_json(path, default=None):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+def write_text(path, text):
+    """Replace the contents of path atomically."""
+    tmp = path.with_name(f'.{path.name}.tmp')
+    try:
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
 
-def tex_compile(file, *, engine='pdflatex', runs=2):
-    wd = file.parent
+def write_json(path, data):
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+RERUNRE = re.compile(r'(Rerun to get|Please rerun|Rerun LaTeX|'
+                     r'Label\(s\) may have changed)')
+
+TexResult = namedtuple('TexResult', ('success', 'passes'))
+
+# Per process limits: wall-clock and CPU seconds, and memory in bytes
+Limits = namedtuple('Limits', ('timeout', 'cpu', 'memory'),
+                    defaults=(None, None, None))
+
+
+class BuildTimeout(RuntimeError):
+    pass
+
+
+def _set_rlimits(pid, limits):
+    import resource
+    for rlimit, value in ((resource.RLIMIT_CPU, limits.cpu),
+                          (resource.RLIMIT_AS, limits.memory)):
+        if value:
+            if pid is None:
+                resource.setrlimit(rlimit, (value, value))
+            else:
+                resource.prlimit(pid, rlimit, (value, value))
+
+def _rlimit_hooks(limits):
+    """Return the preexec_fn setting limits in the child, if needed, and
+    whether they are instead set with prlimit once the child started."""
+    if os.name != 'posix' or not (limits.cpu or limits.memory):
+        return None, False
+    if sys.platform.startswith('linux'):
+        return None, True
+    # prlimit is Linux only, elsewhere set the limits in the child
+    return (lambda: _set_rlimits(None, limits)), False
+
+def _kill_group(proc):
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except ProcessLookupError:
+        pass
+
+def run_limited(args, cwd=None, limits=None):
+    """Run args to completion within limits and return the
+    CompletedProcess.
+
+    The process runs in its own session, so that on timeout, or if the
+    caller is interrupted, the whole process group is killed, including
+    anything the engine spawned. CPU and memory limits are applied to
+    the process as resource limits. Raises BuildTimeout on timeout.
+    """
+    limits = limits or Limits()
+    preexec_fn, use_prlimit = _rlimit_hooks(limits)
+    proc = Popen(args, cwd=cwd, stdout=PIPE, stderr=PIPE,
+                 start_new_session=os.name == 'posix',
+                 preexec_fn=preexec_fn)
+    try:
+        if use_prlimit:
+            _set_rlimits(proc.pid, limits)
+        stdout, stderr = proc.communicate(timeout=limits.timeout)
+    except TimeoutExpired:
+        _kill_group(proc)
+        proc.communicate()
+        raise BuildTimeout(f'{Path(args[0]).name} timed out after '
+                           f'{limits.timeout}s')
+    except BaseException:
+        _kill_group(proc)
+        proc.wait()
+        raise
+    return CompletedProcess(args, proc.returncode, stdout, stderr)
+
+def _hash_if_exists(path):
+    try:
+        return hash_file(path)
+    except FileNotFoundError:
+        return None
+
+def needs_rerun(log_file, aux_before, aux_after):
+    # A new aux file is a change too: the first pass in a fresh build
+    # directory writes it, and e.g. a table of contents is only typeset
+    # from it on the next pass, without any rerun request in the log.
+    if aux_before != aux_after and aux_after is not None:
+        return True
+    try:
+        log = log_file.read_text(errors='replace')
+    except FileNotFoundError:
+        return False
+    return RERUNRE.search(log) is not None
+
+def tex_passes(file, *, engine='pdflatex', max_runs=3, fmt=None):
+    """Generator deciding the engine passes needed to build file.
+
+    Yields the command line of each pass and must be sent the
+    CompletedProcess of that pass. The engine is rerun only while the log
+    asks for it or the aux file changes between passes, up to max_runs
+    passes. If fmt is given, the engine loads that precompiled format.
+    Returns a TexResult recording whether the build succeeded and how
+    many passes it took.
+    """
     target = file.name
-    logger.info(f'Building {target} with {engine} in {wd}.')
-    for _ in range(runs):
-        ck = run([engine, '--interaction=nonstopmode', target], cwd=wd,
-                 stdout=PIPE, stderr=PIPE)
+    aux = file.with_suffix('.aux')
+    log = file.with_suffix('.log')
+    logger.info(f'Building {target} with {engine} in {file.parent}.')
+    args = [engine, '--interaction=nonstopmode']
+    if fmt is not None:
+        args.append(f'-fmt={fmt}')
+    passes = 0
+    while passes < max_runs:
+        aux_before = _hash_if_exists(aux)
+        ck = yield [*args, target]
+        passes += 1
         logger.debug(f'Build of {target} returned '
                        f'with code {ck.returncode}')
         if ck.returncode:
-            outcome=False
+            logger.debug(ck.stdout.decode(errors='replace'))
+            return TexResult(False, passes)
+        if not needs_rerun(log, aux_before, _hash_if_exists(aux)):
             break
     else:
-        outcome=True
-    return outcome
+        logger.warning(f'{target} still requests a rerun after '
+                       f'{passes} passes')
+    return TexResult(True, passes)
+
+def tex_compile(file, *, limits=None, **options):
+    """Build file with the passes decided by tex_passes, each running
+    within limits, see run_limited. Returns a TexResult."""
+    passes = tex_passes(file, **options)
+    number = 1
+    try:
+        args = next(passes)
+        while True:
+            with span('engine pass', file=file.name, number=number):
+                ck = run_limited(args, cwd=file.parent, limits=limits)
+            number += 1
+            args = passes.send(ck)
+    except StopIteration as stop:
+        return stop.value
 
 def parse_for_figures(text):
     pat = r'\\includegraphics(?P<opt>\[.+\])?\{(?P<fig>.+)\}'
     return [m['fig'] for m in re.finditer(pat, text)]
 
-def make_launcher(executable):
-    from subprocess import Popen, PIPE
+def make_launcher(executable, timeout=None):
     def wrapper(*args):
-        proc = Popen([executable, *args], stdout=PIPE, stderr=PIPE)
-        proc.wait()
+        try:
+            run_limited([executable, *args], limits=Limits(timeout=timeout))
+        except BuildTimeout:
+            logger.warning(f'Closed {executable} after {timeout}s')
     return wrapper
         
 
@@ -0,0 +1,198 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _stat(path):
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class PollingMonitor:
+    """Detect changes in a set of directories by polling file mtimes."""
+
+    def __init__(self):
+        self.dirs = []
+        self.state = dict()
+
+    def _snapshot(self):
+        state = dict()
+        for path in self.dirs:
+            state[path] = _stat(path)
+            if state[path] is None:
+                continue
+            for child in path.iterdir():
+                state[child] = _stat(child)
+        return state
+
+    def watch(self, dirs):
+        self.dirs = list(dirs)
+        self.state = self._snapshot()
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        state = self._snapshot()
+        changed = {path for path in state.keys() | self.state.keys()
+                   if state.get(path) != self.state.get(path)}
+        self.state = state
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyMonitor:
+    """Detect changes in a set of directories with inotify."""
+
+    def __init__(self):
+        from inotify_simple import INotify, flags
+        self.inotify = INotify()
+        self.mask = (flags.CLOSE_WRITE | flags.CREATE | flags.DELETE
+                     | flags.MOVED_TO | flags.MOVED_FROM)
+        self.watches = dict()
+
+    def watch(self, dirs):
+        dirs = set(dirs)
+        for wd, path in list(self.watches.items()):
+            if path not in dirs:
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+                del self.watches[wd]
+        watched = set(self.watches.values())
+        for path in dirs - watched:
+            if path.exists():
+                self.watches[self.inotify.add_watch(path, self.mask)] = path
+
+    def changes(self, timeout):
+        events = self.inotify.read(timeout=int(timeout * 1000))
+        return {self.watches[event.wd] / event.name for event in events
+                if event.wd in self.watches}
+
+    def close(self):
+        self.inotify.close()
+
+
+def get_monitor():
+    try:
+        return InotifyMonitor()
+    except (ImportError, OSError):
+        logger.debug('inotify not available, falling back to polling')
+        return PollingMonitor()
+
+
+class Watcher:
+    """Rebuild previews and sheets when their sources change.
+
+    Targets are problem ids, whose previews are rebuilt, or sheet name
+    patterns. Bursts of changes are collected until nothing has changed
+    for debounce seconds, and only the targets that depend on the changed
+    files are rebuilt, in build directories that are kept between builds.
+    """
+
+    def __init__(self, store, targets, mode='questions', jobs=1,
+                 interval=0.5, debounce=0.3):
+        self.store = store
+        self.mode = mode
+        self.jobs = jobs
+        self.interval = interval
+        self.debounce = debounce
+        self.previews = [t for t in targets if store.index.has_problem(t)]
+        self.patterns = [t for t in targets if t not in self.previews]
+        if not targets:
+            self.patterns = ['*']
+        self.watch_dir = store.get_watch_dir()
+        self.monitor = get_monitor()
+        self.sheets = []
+
+    def global_files(self):
+        store = self.store
+        return {store.get_sheet_file(), store.get_template_file(),
+                store.conf_path / store.preview_template,
+                store.get_config_file()}
+
+    def watched_dirs(self):
+        store = self.store
+        dirs = {store.conf_path, store.conf_path / store.include}
+        problems = set(self.previews)
+        for sheet in self.sheets:
+            problems.update(id_ for id_, _ in sheet.problem_refs)
+        for id_ in problems:
+            dirs.add(store.problems_path / id_)
+            dirs.add(store.problems_path / id_ / 'attach')
+        return dirs
+
+    def wait_for_changes(self):
+        changed = set()
+        while not changed:
+            changed = self.monitor.changes(self.interval)
+        while True:
+            more = self.monitor.changes(self.debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    def classify(self, changed):
+        """Split changed paths into changed problem ids and global changes."""
+        store = self.store
+        problems = set()
+        everything = False
+        global_files = self.global_files()
+        include_dir = store.conf_path / store.include
+        for path in changed:
+            if path in global_files or path.parent == include_dir:
+                everything = True
+                continue
+            try:
+                rel = path.relative_to(store.problems_path)
+            except ValueError:
+                continue
+            problems.add(rel.parts[0])
+        return problems, everything
+
+    def build_previews(self, ids):
+        for id_ in ids:
+            sheet = self.store.get_problem(id_).get_preview_sheet(id_)
+            yield from self.store.write_and_compile(
+                'mixed', [sheet], self.watch_dir,
+                self.store.preview_template,
+                build_root=self.watch_dir / 'build' / 'previews')
+
+    def build_sheets(self, sheets):
+        if not sheets:
+            return
+        yield from self.store.write_and_compile(
+            self.mode, sheets, self.store.get_output_dirs(self.mode),
+            self.store.template, jobs=self.jobs,
+            manifest=self.store.get_build_manifest(),
+            build_root=self.watch_dir / 'build' / 'sheets')
+
+    def rebuild(self, problems=None, everything=True):
+        """Rebuild the affected targets and yield their BuildResults."""
+        self.sheets = self.store.get_sheets(self.patterns)
+        self.monitor.watch(self.watched_dirs())
+        if everything:
+            previews, sheets = self.previews, self.sheets
+        else:
+            previews = [id_ for id_ in self.previews if id_ in problems]
+            sheets = [sheet for sheet in self.sheets
+                      if any(id_ in problems
+                             for id_, _ in sheet.problem_refs)]
+        yield from self.build_previews(previews)
+        yield from self.build_sheets(sheets)
+
+    def __iter__(self):
+        """Yield the BuildResults of each round of rebuilds, forever."""
+        try:
+            yield list(self.rebuild())
+            while True:
+                problems, everything = self.classify(self.wait_for_changes())
+                if problems or everything:
+                    yield list(self.rebuild(problems, everything))
+        finally:
+            self.monitor.close()
@@ -11,6 +11,7 @@ setup(name='probman',
 	     'console_scripts' : ['probman=probman.cli:main']
       },
       install_requires=['click', 'jinja2'],
+      extras_require={'watch': ['inotify_simple']},
       package_data = {'probman' : ['data/template',
                                    'data/sheets',
                                    'data/config'
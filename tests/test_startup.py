@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from benchmarks.run import STARTUP_BUDGET
+
+ROOT = Path(__file__).resolve().parents[1]
+ENV = dict(os.environ, PYTHONPATH=os.pathsep.join(
+    filter(None, (str(ROOT), os.environ.get('PYTHONPATH')))))
+
+
+def _python(code, *argv):
+    return subprocess.run([sys.executable, '-c', code, *argv], env=ENV,
+                          capture_output=True, text=True, check=True)
+
+
+def test_cli_import_is_lazy():
+    out = _python('import sys, probman.cli\n'
+                  "for name in ('jinja2', 'probman.problemstore', "
+                  "'probman.checker'):\n"
+                  '    print(name, name in sys.modules)')
+    assert out.stdout.split() == ['jinja2', 'False',
+                                  'probman.problemstore', 'False',
+                                  'probman.checker', 'False']
+
+
+def test_help_within_budget():
+    times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        _python('from probman.cli import main; main()', '--help')
+        times.append(time.perf_counter() - start)
+    assert min(times) < STARTUP_BUDGET, (
+        f'probman --help took {min(times):.3f}s, '
+        f'budget is {STARTUP_BUDGET}s')
+
+
+def test_globals_shared_across_contexts():
+    from contextvars import copy_context
+    import probman
+    config = copy_context().run(lambda: probman.get_globals()['config'])
+    assert probman.get_globals()['config'] is config
@@ -0,0 +1,44 @@
+from subprocess import CompletedProcess
+
+from probman.utils import tex_passes
+
+
+def _drive(file, engine):
+    """Run the tex_passes generator for file, calling engine(number) for
+    each pass, and return its TexResult."""
+    passes = tex_passes(file, max_runs=5)
+    number = 1
+    try:
+        args = next(passes)
+        while True:
+            engine(number)
+            number += 1
+            args = passes.send(CompletedProcess(args, 0, b'', b''))
+    except StopIteration as stop:
+        return stop.value
+
+
+def test_new_aux_file_triggers_rerun(tmp_path):
+    target = tmp_path / 'sheet.tex'
+    target.write_text('\\tableofcontents')
+
+    def engine(number):
+        # Writes the aux file but never asks for a rerun in the log
+        (tmp_path / 'sheet.aux').write_text('\\relax\n')
+        (tmp_path / 'sheet.log').write_text('No file sheet.toc.\n')
+
+    result = _drive(target, engine)
+    assert result.success
+    assert result.passes == 2
+
+
+def test_stable_aux_file_needs_one_pass(tmp_path):
+    target = tmp_path / 'sheet.tex'
+    target.write_text('text')
+    (tmp_path / 'sheet.aux').write_text('\\relax\n')
+
+    def engine(number):
+        (tmp_path / 'sheet.aux').write_text('\\relax\n')
+        (tmp_path / 'sheet.log').write_text('')
+
+    assert _drive(target, engine).passes == 1